@@ -2,10 +2,19 @@ import yaml
 from peewee import Model, OP
 from playhouse.postgres_ext import PostgresqlExtDatabase
 
+from TavernCrier.util.metrics import POSTGRES_QUERY_SECONDS
+
 with open('./config.yaml', 'r') as config:
     raw_config = yaml.load(config.read(), Loader=yaml.FullLoader)
 
-postgres_db = PostgresqlExtDatabase(
+class InstrumentedPostgresqlExtDatabase(PostgresqlExtDatabase):
+    def execute_sql(self, sql, *args, **kwargs):
+        statement = sql.split(None, 1)[0].upper() if sql.strip() else "UNKNOWN"
+        with POSTGRES_QUERY_SECONDS.time(statement=statement):
+            return super(InstrumentedPostgresqlExtDatabase, self).execute_sql(sql, *args, **kwargs)
+
+
+postgres_db = InstrumentedPostgresqlExtDatabase(
     raw_config['database_info']['postgres']['database'],
     host=raw_config['database_info']['postgres']['host'],
     user=raw_config['database_info']['postgres']['username'],
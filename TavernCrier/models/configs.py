@@ -40,9 +40,8 @@ class GuildConfigField(JSONField):
             return super(GuildConfigField, self).db_value(value)
 
     def python_value(self, value):
-        if not self.disco_model:
-            self.disco_model = GuildConfig(value)
-        return self.disco_model
+        # The field is shared by every row, so each row gets its own model.
+        return GuildConfig(value)
 
 
 @PostgresBase.register
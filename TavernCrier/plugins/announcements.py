@@ -1,34 +1,76 @@
+import hashlib
+import json
 import re
+import time
 from datetime import datetime
 
 import gevent
 import requests.exceptions
+from gevent.lock import Semaphore
 from disco.api.http import APIException
 from disco.bot import Plugin
 from disco.types.application import InteractionType
 from disco.types.message import MessageEmbed, ActionRow, ComponentTypes, ButtonStyles, MessageModal, \
     TextInputStyles, SelectOption, ButtonComponent, SelectMenuComponent, TextInputComponent, component
 from pytz import timezone
-from redis.commands.json.path import Path
 
 from TavernCrier import StreamNotificationsConfig, config as bot_config, StreamEndedAction
 from TavernCrier.db import postgres_db
 from TavernCrier.models.configs import GuildConfigs, StreamConfigs
 from TavernCrier.redis import rdb
+from TavernCrier.util.adaptive import AdaptivePollScheduler
+from TavernCrier.util.cache import stream_configs, guild_configs, live_stream_cache, avatars, vods
+from TavernCrier.util.eventsub import EventSubClient
+from TavernCrier.util.jobs import OutboundQueue, JobFailed
+from TavernCrier.util.leader import LeaderElection
+from TavernCrier.util.loop import PollLoop
+from TavernCrier.util.metrics import DISCORD_REQUEST_SECONDS, DISCORD_MESSAGES, STREAMERS_POLLED, LIVE_STREAMS, \
+    ANNOUNCEMENT_LATENCY_SECONDS, Gauge
+from TavernCrier.util.ratelimit import RequestPriority
+from TavernCrier.util.shard import ShardCoordinator, LostOwnership
+from TavernCrier.util.state import load_live_updates, set_live_update, remove_live_update, migrate_live_update_keys, \
+    load_currently_live, live_streamer_ids, diff_currently_live, write_currently_live, migrate_currently_live, record_stream_history, \
+    commit_notification, set_pending_live_update, live_update_key, StreamOnline, StreamOffline
 from TavernCrier.util.template import get_embed_template, get_component_template
-from TavernCrier.util.twitch import make_twitch_request
+from TavernCrier.util.tracing import AnnouncementTrace, record_trace, load_traces, percentiles
+from TavernCrier.util.twitch import make_twitch_request, get_live_streams, parse_twitch_timestamp
+
+EVENTSUB_CONFIG = bot_config.get('eventsub') or {}
+ADAPTIVE_POLLING_CONFIG = bot_config.get('adaptive_polling') or {}
+SHARDING_CONFIG = bot_config.get('sharding') or {}
+LEADER_ELECTION_CONFIG = bot_config.get('leader_election') or {}
+
+# Every Discord send, edit and delete made for a stream goes through here
+outbound = OutboundQueue("outbound", **(bot_config.get('outbound') or {}))
+OUTBOUND_JOBS = Gauge("taverncrier_outbound_jobs", "Outbound Discord jobs by state.",
+                      lambda: {(('state', state),): count for state, count in outbound.metrics().items()})
+
+LIVE_UPDATE_FORCE_REFRESH_INTERVAL = bot_config.get('live_update_force_refresh_interval', 900)
 
 TWITCH_URL_RE = re.compile(r"(https://twitch\.tv/?[a-zA-Z0-9][\w]{2,24})")
 
-def get_user_avatar(user_id):
-    if rdb.get(f'avatar_cache:{user_id}'):
-        return rdb.get(f'avatar_cache:{user_id}')
-    else:
-        resp_code, ujson = make_twitch_request("https://api.twitch.tv/helix/users", "GET",
-                                               params={'id': user_id})
 
-        rdb.set(f'avatar_cache:{user_id}', ujson['data'][0]['profile_image_url'], ex=259200)
-        return ujson['data'][0]['profile_image_url']
+# Components that change what build_message_embed and the watch button render
+RENDERED_COMPONENTS = frozenset(["username", "title", "category", "viewers", "live_since", "tags", "preview_image",
+                                 "button", "mature_badge"])
+
+
+def fingerprint_message(content, render_hash):
+    """
+    Hash of everything in a notification that matters, taken before the "Last Updated" footer is added.
+    """
+    return hashlib.sha1(f"{render_hash}:{content}".encode('utf-8')).hexdigest()
+
+
+def announcement_key(user_id, stream_id, cfg_id):
+    return f"announce:{user_id}:{stream_id}:{cfg_id}"
+
+
+def refused(e):
+    """
+    Discord turned the request down (unknown message, missing access, etc.), as opposed to failing to handle it.
+    """
+    return e.response is not None and e.response.status_code < 500 and e.response.status_code != 429
 
 CONFIGURABLE_COMPONENTS = [
     "username",
@@ -59,8 +101,92 @@ CONFIGURABLE_COMPONENTS = [
 
 class AnnouncementPlugin(Plugin):
     def load(self, ctx):
+        migrated = migrate_live_update_keys()
+        if migrated:
+            self.log.info(f"Migrated {migrated} live update keys to per streamer hashes.")
+        if migrate_currently_live():
+            self.log.info("Migrated currently_live to a per streamer hash.")
+
+        stream_configs.load()
+        guild_configs.load()
+
+        self.process_lock = Semaphore()
+        self.loaded_at = time.time()
+        self.last_reconcile = 0
+        self.pending_online = set()
+        self.poll_scheduler = None
+        if ADAPTIVE_POLLING_CONFIG.get('enabled'):
+            self.poll_scheduler = AdaptivePollScheduler(bot_config.check_interval,
+                                                        max_interval=ADAPTIVE_POLLING_CONFIG.get('max_interval', 300),
+                                                        threshold=ADAPTIVE_POLLING_CONFIG.get('likely_live_threshold', 0.25),
+                                                        min_history=ADAPTIVE_POLLING_CONFIG.get('min_history', 3),
+                                                        max_requests=ADAPTIVE_POLLING_CONFIG.get('max_requests_per_tick', 10))
+
+        # Either every process handles its share of streamers, or one elected process handles all of them.
+        self.shards = None
+        self.leader = None
+        if SHARDING_CONFIG.get('enabled'):
+            self.shards = ShardCoordinator(partitions=SHARDING_CONFIG.get('partitions', 64),
+                                           heartbeat_interval=SHARDING_CONFIG.get('heartbeat_interval', 5),
+                                           lease_ttl=SHARDING_CONFIG.get('lease_ttl', 15))
+        else:
+            self.leader = LeaderElection("poll_leader", lease_ttl=LEADER_ELECTION_CONFIG.get('lease_ttl', 10),
+                                         renew_interval=LEADER_ELECTION_CONFIG.get('renew_interval', 3),
+                                         on_elected=self.on_elected)
+
+        self.eventsub = None
+        if EVENTSUB_CONFIG.get('enabled'):
+            self.eventsub = EventSubClient(lambda: [user for user in stream_configs.get() if self.handles(user)],
+                                           self.on_stream_online,
+                                           self.on_stream_offline,
+                                           url=EVENTSUB_CONFIG.get('url', EventSubClient.URL),
+                                           sync_interval=EVENTSUB_CONFIG.get('sync_interval', 30))
+
+        outbound.handler("announce", self.send_announcement)
+        outbound.handler("live_update", self.send_live_update)
+        outbound.handler("end_action", self.run_end_action)
+
         super(AnnouncementPlugin, self).load(ctx)
 
+        if self.shards:
+            self.spawn(self.shards.run)
+        if self.leader:
+            self.spawn(self.leader.run)
+
+        for _ in range(outbound.workers):
+            self.spawn(outbound.work)
+
+        self.poll_loop = PollLoop("stream_grab", self.stream_grab_schedule, bot_config.check_interval,
+                                  max_backoff=bot_config.get('poll_max_backoff', 300),
+                                  timeout=bot_config.get('poll_tick_timeout', 300))
+        self.spawn(self.poll_loop.run)
+
+        if self.eventsub:
+            self.spawn(self.eventsub.run)
+            self.spawn(self.eventsub.sync_loop)
+
+    def unload(self, ctx):
+        # Hand over now rather than once our leases expire, so a rolling deploy doesn't leave a gap.
+        if self.shards:
+            self.shards.leave()
+        if self.leader:
+            self.leader.resign()
+        super(AnnouncementPlugin, self).unload(ctx)
+
+    def handles(self, user_id):
+        """
+        Whether this process polls and announces the streamer, either because its shard owns them or because it's
+        the elected leader.
+        """
+        if self.shards:
+            return self.shards.owns(user_id)
+        return self.leader is None or self.leader.is_leader
+
+    def on_elected(self):
+        # Take over the EventSub subscriptions now instead of on the next sync.
+        if self.eventsub and self.eventsub.connected:
+            self.eventsub.sync()
+
     def get_next_interaction_event(self, user=None, message_id=None, conditional=None, timeout=10):
         event = None
         try:
@@ -108,7 +234,7 @@ class AnnouncementPlugin(Plugin):
                 base_embed.set_image(url=streamer["offline_image_url"] or "https://static-cdn.jtvnw.net/ttv-static/404_preview-1920x1080.jpg")
         else:
             if 'username' in enabled_components:
-                profile_picture = get_user_avatar(streamer['user_id'])
+                profile_picture = avatars.get(streamer['user_id'])
                 base_embed.set_author(name=f"{streamer['user_name']}", icon_url=profile_picture,
                                       url=f"https://twitch.tv/{streamer['user_login']}")
 
@@ -275,160 +401,407 @@ class AnnouncementPlugin(Plugin):
 
         return to_return
 
-    @Plugin.schedule(bot_config.check_interval, init=False)
     def stream_grab_schedule(self):
-        configs = postgres_db.execute_sql(
-            """
-                SELECT 
-                streamer_id, 
-                array_agg(json_build_object('id', id, 'channel', notification_channel, 'role', notification_role, 'config', config, 'messages', messages)) 
-                FROM stream_configs GROUP BY streamer_name, streamer_id
-            """)
+        """
+        One poll tick, run by `self.poll_loop`. Returns False if Helix couldn't be reached, so the loop backs off.
+        """
+        if self.leader and not self.leader.is_leader:
+            return
 
-        cfg_dict = {str(row[0]): row[1] for row in configs}
+        cfg_dict = stream_configs.get()
+        live_ids = live_streamer_ids()
+        if self.shards:
+            cfg_dict = {user: cfgs for user, cfgs in cfg_dict.items() if self.shards.owns(user)}
+            live_ids = {user for user in live_ids if self.shards.owns(user)}
+
+        # With EventSub connected go lives and ends are pushed to us. Between reconciliation sweeps only poll
+        # live streamers for their live updates, and whoever EventSub can't tell us about.
+        checked = None
+        if self.eventsub and self.eventsub.connected and \
+                time.time() - self.last_reconcile < EVENTSUB_CONFIG.get('reconcile_interval', 300):
+            checked = {user for user in live_ids | self.eventsub.unsubscribed | self.pending_online
+                       if user in cfg_dict}
+        elif self.poll_scheduler:
+            # Streamers that are live right now are always checked, otherwise their stream would never end.
+            checked = self.poll_scheduler.select(cfg_dict.keys() | live_ids, live_ids)
+
+        reconciling = checked is None
+        if reconciling and self.shards:
+            # Everyone this process handles, the rest belong to other workers.
+            checked = cfg_dict.keys() | live_ids
+
+        polled = cfg_dict.keys() if checked is None else checked
+        code, live_streams = get_live_streams(polled)
+        STREAMERS_POLLED.inc(len(polled))
+        if code != 200:
+            self.log.error(f"Unable to get live streams from Twitch ({code})")
+            return False
 
-        to_check_live = "&user_id=".join(cfg_dict.keys())
+        LIVE_STREAMS.set(len(live_streams))
+        if reconciling:
+            self.last_reconcile = time.time()
+        elif self.poll_scheduler:
+            self.poll_scheduler.polled(checked)
 
-        rjson = None
-        code = None
+        try:
+            with self.process_lock:
+                self.process_streams(cfg_dict, live_streams, checked)
+        except LostOwnership as e:
+            # Leadership or partitions moved while we polled, whoever has them now picks them up.
+            self.log.info(f"Dropping poll tick: {e}")
+            return
+        self.pending_online.difference_update(live_streams.keys())
 
-        retry = 0
-        while retry < 5:
-            try:
-                code, rjson = make_twitch_request("https://api.twitch.tv/helix/streams", "GET", params=f"type=live&first=100&user_id={to_check_live}")
+    def on_stream_online(self, event, message_timestamp):
+        user_id = event['broadcaster_user_id']
+        cfg_dict = stream_configs.get()
+        if user_id not in cfg_dict or not self.handles(user_id):
+            return
+
+        # Helix can take a moment to list a stream that just started.
+        for attempt in range(3):
+            code, live_streams = get_live_streams([user_id])
+            if code == 200 and user_id in live_streams:
                 break
-            except Exception as e:
-                retry += 1
-                self.log.error(f"Unable to connect to Twitch's API. Retrying... ({retry}) %s", e)
-                gevent.sleep(5)
-
-        # TODO: Bot Error Log
-        if retry == 5:
-            self.log.error("Max of 5 retries exceeded. Waiting 1 minute before restarting schedule.")
-            active_greenlet = self.schedules['stream_grab_schedule']
-            del self.schedules['stream_grab_schedule']
-            gevent.sleep(60)
-            self.register_schedule(self.stream_grab_schedule, bot_config.check_interval, init=True)
-            self.log.info("Schedule restarted.")
-            active_greenlet.kill()
+            gevent.sleep(2)
+        else:
+            self.log.info(f"[EventSub] {event['broadcaster_user_login']} went live but isn't listed yet, leaving it to the poller.")
+            self.pending_online.add(user_id)
+            return
 
-        if code != 200:
+        # How long after the event each announcement was posted is logged by send_announcement
+        try:
+            with self.process_lock:
+                self.process_streams(cfg_dict, live_streams, {user_id}, source="eventsub",
+                                     event_at=parse_twitch_timestamp(message_timestamp).timestamp())
+        except LostOwnership as e:
+            self.log.info(f"[EventSub] Dropping {event['broadcaster_user_login']} going live: {e}")
+
+    def on_stream_offline(self, event, message_timestamp):
+        user_id = event['broadcaster_user_id']
+        self.pending_online.discard(user_id)
+        if not self.handles(user_id):
             return
+        try:
+            with self.process_lock:
+                self.process_streams(stream_configs.get(), {}, {user_id})
+        except LostOwnership as e:
+            self.log.info(f"[EventSub] Dropping {event['broadcaster_user_login']} going offline: {e}")
+
+    def process_streams(self, cfg_dict, live_streams, checked=None, source="poll", event_at=None):
+        """
+        Announces, updates and ends notifications for the streamers in `checked` (everyone if None), given which
+        of them are live. Used by both the poll tick and EventSub notifications, `source` says which for tracing,
+        and `event_at` is when Twitch sent the notification.
+
+        Nothing is sent from here, the Discord calls are queued on `outbound` in the same transaction as the state
+        change they belong to.
+        """
+        live_stream_cache.update(live_streams.values())
+        avatars.prefetch(live_streams.keys(), priority=RequestPriority.POLL)
 
         live_users = {}
-
-        if rjson.get('data') and len(rjson['data']):
-            for stream in rjson['data']:
-                live_users[stream['user_id']] = []
-                cfgs = cfg_dict[stream['user_id']]
-                for config in cfgs:
-                    update = False
-                    cid = None
-                    mid = None
-                    if rdb.exists(f"live_update:{stream['user_id']}:{config['id']}"):
-                        data = rdb.json().get(f"live_update:{stream['user_id']}:{config['id']}")
-                        live_users[stream['user_id']].append(
-                            {'cid': data['cid'], 'mid': data['mid'], 'username': stream['user_name'],
-                             'end_action': config['config']['stream_end_action']})
-                        if datetime.now().timestamp() - data['last_updated'] < bot_config.live_update_interval:
-                            continue
-                        elif datetime.now().timestamp() - data['last_updated'] >= bot_config.rouge_key_removal_interval:
-                            self.log.error(f"Rouge Live Key Found. Deleting and recreating. Key ID: live_update:{stream['user_id']}:{config['id']}")
-                            rdb.json().delete(f"live_update:{stream['user_id']}:{config['id']}")
-                        else:
-                            update = True
-                            cid = data['cid']
-                            mid = data['mid']
-                    enabled_components = [c for c, value in config['config'].items() if value == True]
-                    embed = self.build_message_embed(enabled_components, stream)
-                    components = None
-                    if 'button' in enabled_components:
-                        main_ar = ActionRow()
-                        preview_btn = ButtonComponent(get_component_template("stream_notification_url_button"))
-                        preview_btn.url = f"https://twitch.tv/{stream['user_login']}"
-                        if 'mature_badge' in enabled_components:
-                            preview_btn.label += "🔞"
-                        main_ar.add_component(preview_btn)
-                        components = [main_ar]
-
-                    msg = config['messages'][0]
-                    if '{role}' in msg and not config['role']:
-                        msg = msg.replace("{role}", "")
-                    elif '{role}' in msg:
-                        msg = msg.format(role=f"<@&{config['role']}>")
-
-                    if update:
-                        now = datetime.now(tz=timezone("America/New_York"))
-                        embed.set_footer(text="Last Updated")
-                        embed.timestamp = now
-                        try:
-                            self.client.api.channels_messages_modify(channel=cid, message=mid,
-                                                                     content=msg,
-                                                                     embeds=[embed],
-                                                                     components=components)
-
-                            rdb.json().set(f"live_update:{stream['user_id']}:{config['id']}", Path.root_path(), {'mid': mid, 'cid': cid,'last_updated': now.timestamp()})
-                        except APIException as e:
-                            self.log.error(f"Unable to update message: Streamer: {stream['user_login']} Config ID: {config['id']}. Removing Live Update fromm Redis!")
-                            rdb.json().delete(f"live_update:{stream['user_id']}:{config['id']}")
-                            continue
-                    else:
-                        try:
-                            if components:
-                                components = [c.to_dict() for c in components]
-                            created_msg = self.client.api.channels_messages_create(config['channel'],
-                                                                                   content=msg,
-                                                                                   embeds=[embed],
-                                                                                   components=components,
-                                                                                   allowed_mentions={'parse': ["roles", "users", "everyone"]})
-
-                            live_users[stream['user_id']].append({'cid': config['channel'], 'mid': created_msg.id, 'username': stream['user_name'], 'end_action': config['config']['stream_end_action']})
-
-                            if 'live_update' in enabled_components:
-                                rdb.json().set(f"live_update:{stream['user_id']}:{config['id']}", Path.root_path(), {'mid': created_msg.id, 'cid': config['channel'],'last_updated': datetime.now().timestamp()})
-                        except APIException as e:
-                            self.log.error(f"Unable to send Message for Config ID {config['id']}: {e.msg}")
-
-        currently_live = {}
-        if rdb.exists("currently_live"):
-            currently_live = rdb.json().get("currently_live", Path.root_path())
-
-        prev_live_users = [user for user in currently_live.keys() if user not in live_users.keys()]
-
-        for user in prev_live_users:
-            keys = rdb.keys(f"live_update:{user}:*")
-            for key in keys:
-                rdb.json().delete(key)
-            for notif in currently_live[user]:
-                if notif['end_action'] == StreamEndedAction.EDIT_MESSAGE:
-                    try:
-                        msg = self.client.api.channels_messages_get(channel=notif['cid'], message=notif['mid'])
-                        ar = ActionRow()
-                        go_to_btn = component(get_component_template("stream_end_go_to_channel"))
-                        go_to_btn.emoji = None
-                        go_to_btn.url = f"https://twitch.tv/{notif['username']}"
-                        ar.add_component(go_to_btn)
-                        msg.edit(f"{notif['username']}'s stream has ended.", components=[ar])
-                        # self.client.api.channels_messages_modify(channel=notif['cid'], message=notif['mid'],
-                        #                                          content=f"{notif['username']}'s stream has ended.",
-                        #                                          embeds=None,
-                        #                                          components=None)
-                    except APIException as e:
+        renders = {}
+        skipped_edits = 0
+        queued = 0
+        now = time.time()
+
+        # Nothing gets committed if another process took over, or took over our streamers' partitions, after this.
+        redis_writes = rdb.pipeline(transaction=True)
+        if self.leader:
+            self.leader.fence(redis_writes)
+        elif self.shards:
+            self.shards.fence(redis_writes, live_streams.keys() | (checked or set()))
+
+        # Load the live update state for every live streamer in one round trip, writes are committed together at the end.
+        currently_live = load_currently_live()
+        if checked is not None:
+            currently_live = {user: stream for user, stream in currently_live.items() if user in checked}
+        live_update_state = load_live_updates(live_streams.keys())
+
+        for stream in live_streams.values():
+            live_users[stream['user_id']] = {'username': stream['user_name'], 'stream_id': stream['id']}
+            cfgs = cfg_dict.get(stream['user_id'], [])
+            live_updates = live_update_state[stream['user_id']]
+
+            # Configs that have since been deleted keep their message until the stream ends, it just isn't updated.
+            cfg_ids = {str(config['id']) for config in cfgs}
+            for cfg_id, data in live_updates.items():
+                if cfg_id not in cfg_ids and data.get('live_update', True):
+                    set_live_update(redis_writes, stream['user_id'], cfg_id, dict(data, live_update=False))
+
+            for config in cfgs:
+                data = live_updates.get(str(config['id']))
+                if data:
+                    if not data.get('pending') and not data.get('live_update', True):
                         continue
-                elif notif['end_action'] == StreamEndedAction.DELETE_MESSAGE:
-                    try:
-                        self.client.api.channels_messages_delete(channel=notif['cid'], message=notif['mid'])
-                    except APIException as e:
+                    if now - data['last_updated'] < bot_config.live_update_interval:
+                        continue
+                    elif now - data['last_updated'] >= bot_config.rouge_key_removal_interval:
+                        self.log.error(f"Rouge Live Key Found. Deleting and recreating. Key ID: live_update:{stream['user_id']} Config ID: {config['id']}")
+                        remove_live_update(redis_writes, stream['user_id'], config['id'])
+                        outbound.forget(redis_writes, announcement_key(stream['user_id'], stream['id'], config['id']))
+                        data = None
+                    elif data.get('pending'):
+                        continue
+
+                enabled_components = [c for c, value in config['config'].items() if value == True]
+                embed, components, render_hash = self.render_notification(stream, enabled_components, renders)
+                rendered_at = time.time()
+
+                msg = config['messages'][0]
+                if '{role}' in msg and not config['role']:
+                    msg = msg.replace("{role}", "")
+                elif '{role}' in msg:
+                    msg = msg.format(role=f"<@&{config['role']}>")
+
+                fingerprint = fingerprint_message(msg, render_hash)
+
+                if data:
+                    # Nothing but the "Last Updated" footer would change, don't spend a Discord request on it.
+                    if fingerprint == data.get('fingerprint') and \
+                            now - data.get('last_edited', 0) < LIVE_UPDATE_FORCE_REFRESH_INTERVAL:
+                        skipped_edits += 1
+                        set_live_update(redis_writes, stream['user_id'], config['id'], dict(data, last_updated=now))
                         continue
 
-        rdb.json().delete("currently_live", Path.root_path())
-        rdb.json().set("currently_live", Path.root_path(), live_users)
+                    outbound.push(redis_writes, "live_update", {
+                        'user_id': stream['user_id'], 'stream_id': stream['id'], 'config_id': config['id'],
+                        'cid': data['cid'], 'mid': data['mid'], 'content': msg, 'embed': embed.to_dict(),
+                        'components': components})
+                    set_live_update(redis_writes, stream['user_id'], config['id'],
+                                    dict(data, last_updated=now, last_edited=now, fingerprint=fingerprint))
+                else:
+                    notification = {'cid': config['channel'], 'username': stream['user_name'],
+                                    'end_action': config['config']['stream_end_action'], 'stream_id': stream['id'],
+                                    'live_update': 'live_update' in enabled_components, 'fingerprint': fingerprint}
+                    # Only go lives we saw happen are traced, not ones that were already live when we started.
+                    trace = None
+                    started_at = parse_twitch_timestamp(stream['started_at']).timestamp()
+                    if stream['user_id'] not in currently_live and started_at >= self.loaded_at:
+                        trace = {'source': source, 'started_at': started_at, 'detected_at': now,
+                                 'rendered_at': rendered_at}
+
+                    key = announcement_key(stream['user_id'], stream['id'], config['id'])
+                    job_id = outbound.push(redis_writes, "announce", {
+                        'user_id': stream['user_id'], 'config_id': config['id'], 'notification': notification,
+                        'content': msg, 'embed': embed.to_dict(), 'components': components, 'trace': trace,
+                        'event_at': event_at
+                    }, key=key)
+                    set_pending_live_update(redis_writes, stream['user_id'], config['id'],
+                                            dict(notification, pending=True, job=job_id, last_updated=now),
+                                            outbound.idempotency_key(key))
+                queued += 1
+
+        if skipped_edits:
+            redis_writes.hincrby("stats", "live_update_edits_skipped", skipped_edits)
+
+        went_live, went_offline, changed = diff_currently_live(currently_live, live_users)
+
+        # End actions are queued in the same transaction that removes the stream, so they survive a crash.
+        # The stream's announcement keys go with it: its messages are being ended, so if Twitch relists the same
+        # stream it's announced again rather than left without a message.
+        ended = load_live_updates(went_offline)
+        for user in went_offline:
+            live_stream_cache.discard(user)
+            remove_live_update(redis_writes, user)
+            for cfg_id, data in ended[user].items():
+                stream_id = data.get('stream_id') or currently_live[user].get('stream_id')
+                outbound.forget(redis_writes, announcement_key(user, stream_id, cfg_id))
+                if data.get('mid'):
+                    self.queue_end_action(redis_writes, user, data, currently_live[user])
+                    queued += 1
+
+        write_currently_live(redis_writes, live_users, went_live, went_offline, changed)
+        for user in went_live:
+            record_stream_history(redis_writes, user, "online", now)
+        for user in went_offline:
+            record_stream_history(redis_writes, user, "offline", now)
+        if self.leader:
+            self.leader.execute(redis_writes)
+        elif self.shards:
+            self.shards.execute(redis_writes)
+        else:
+            redis_writes.execute()
+
+        if queued:
+            outbound.notify()
+            self.log.debug(f"Queued {queued} Discord calls ({skipped_edits} live updates skipped)")
+
+        if self.poll_scheduler:
+            for user in went_live + went_offline:
+                self.poll_scheduler.forget(user)
+
+        for user in went_live:
+            self.client.events.emit("StreamOnline", StreamOnline(user, live_streams[user]))
+        for user in went_offline:
+            self.client.events.emit("StreamOffline", StreamOffline(user, list(ended[user].values())))
+
+    @staticmethod
+    def queue_end_action(pipe, user_id, data, stream=None):
+        stream = stream or {}
+        outbound.push(pipe, "end_action", {
+            'user_id': user_id, 'cid': data['cid'], 'mid': data['mid'],
+            'username': data.get('username') or stream.get('username'),
+            'end_action': data.get('end_action', StreamEndedAction.EDIT_MESSAGE),
+            'stream_id': data.get('stream_id') or stream.get('stream_id')
+        }, key=f"end:{data['cid']}:{data['mid']}")
+
+    def send_announcement(self, job):
+        data = job['data']
+        if not rdb.hexists("currently_live", data['user_id']):
+            # The stream ended before we got to it.
+            return
+
+        try:
+            # The nonce makes Discord hand back the same message if a redelivered job sends it again.
+            with DISCORD_REQUEST_SECONDS.time(route="channels_messages_create"):
+                created_msg = self.client.api.channels_messages_create(data['notification']['cid'],
+                                                                       nonce=job['id'][:25], enforce_nonce=True,
+                                                                       content=data['content'],
+                                                                       embeds=[MessageEmbed(data['embed'])],
+                                                                       components=data['components'],
+                                                                       allowed_mentions={'parse': ["roles", "users", "everyone"]})
+            DISCORD_MESSAGES.inc(action="created")
+        except APIException as e:
+            if refused(e):
+                raise JobFailed(f"Unable to send Message for Config ID {data['config_id']}: {e.msg}")
+            raise
+
+        if data.get('trace'):
+            self.record_trace(AnnouncementTrace(sent_at=time.time(), **data['trace']))
+        if data.get('event_at'):
+            latency = time.time() - data['event_at']
+            ANNOUNCEMENT_LATENCY_SECONDS.observe(latency, stage="event", source="eventsub")
+            self.log.info(f"[EventSub] Announced {data['notification']['username']} in {data['notification']['cid']} {latency:.2f}s after the event.")
+
+        entry = dict(data['notification'], job=job['id'], mid=created_msg.id, last_updated=time.time(),
+                     last_edited=time.time())
+
+        committed = commit_notification(data['user_id'], data['config_id'], job['id'], entry)
+        if committed == 1:
+            return
+
+        # The stream ended, or the notification was replaced, while the message was being sent.
+        pipe = rdb.pipeline()
+        if committed == 0:
+            self.queue_end_action(pipe, data['user_id'], entry)
+        else:
+            self.queue_end_action(pipe, data['user_id'], dict(entry, end_action=StreamEndedAction.DELETE_MESSAGE))
+        pipe.execute()
+        outbound.notify()
+
+    def record_trace(self, trace):
+        ANNOUNCEMENT_LATENCY_SECONDS.observe(trace.detection, stage="detection", source=trace.source)
+        ANNOUNCEMENT_LATENCY_SECONDS.observe(trace.delivery, stage="delivery", source=trace.source)
+        try:
+            pipe = rdb.pipeline(transaction=False)
+            record_trace(pipe, trace)
+            pipe.execute()
+        except Exception:
+            # The message is out, don't let the job retry over a trace.
+            self.log.exception("Unable to record announcement trace")
+
+    def send_live_update(self, job):
+        data = job['data']
+        # The entry goes in the same transaction that queues the end action, a retry landing after the stream ended
+        # would turn the ended message back into a live one.
+        if not rdb.hexists(live_update_key(data['user_id']), data['config_id']):
+            return
+
+        now = datetime.now(tz=timezone("America/New_York"))
+        embed = MessageEmbed(data['embed'])
+        embed.set_footer(text="Last Updated")
+        embed.timestamp = now
+        try:
+            with DISCORD_REQUEST_SECONDS.time(route="channels_messages_modify"):
+                self.client.api.channels_messages_modify(channel=data['cid'], message=data['mid'],
+                                                         content=data['content'],
+                                                         embeds=[embed],
+                                                         components=data['components'])
+            DISCORD_MESSAGES.inc(action="edited")
+        except APIException as e:
+            if not refused(e):
+                raise
+            self.log.error(f"Unable to update message: Streamer: {data['user_id']} Config ID: {data['config_id']}. Removing Live Update fromm Redis!")
+            pipe = rdb.pipeline()
+            remove_live_update(pipe, data['user_id'], data['config_id'])
+            outbound.forget(pipe, announcement_key(data['user_id'], data['stream_id'], data['config_id']))
+            pipe.execute()
+
+    def run_end_action(self, job):
+        data = job['data']
+        try:
+            if data['end_action'] == StreamEndedAction.DELETE_MESSAGE:
+                with DISCORD_REQUEST_SECONDS.time(route="channels_messages_delete"):
+                    self.client.api.channels_messages_delete(channel=data['cid'], message=data['mid'])
+                DISCORD_MESSAGES.inc(action="deleted")
+                return
+
+            ar = ActionRow()
+            content = f"{data['username']}'s stream has ended."
+
+            vod = None
+            latest_vods = vods.get(data['user_id']) if data['end_action'] == StreamEndedAction.LINK_TO_VOD else None
+            if latest_vods and data.get('stream_id'):
+                # The stream's own VOD may not be up yet, an older one would link the wrong stream
+                vod = next((v for v in latest_vods if v.get('stream_id') == data['stream_id']), None)
+            elif latest_vods:
+                # Queued before the stream id was recorded, the latest VOD is the best guess
+                vod = latest_vods[0]
+
+            if vod:
+                vod_btn = component(get_component_template("stream_end_watch_vod"))
+                vod_btn.url = vod['url']
+                ar.add_component(vod_btn)
+                content = f"{data['username']}'s stream has ended, catch the VOD!"
+
+            go_to_btn = component(get_component_template("stream_end_go_to_channel"))
+            go_to_btn.emoji = None
+            go_to_btn.url = f"https://twitch.tv/{data['username']}"
+            ar.add_component(go_to_btn)
+
+            with DISCORD_REQUEST_SECONDS.time(route="channels_messages_modify"):
+                self.client.api.channels_messages_modify(channel=data['cid'], message=data['mid'],
+                                                         content=content, components=[ar.to_dict()])
+            DISCORD_MESSAGES.inc(action="edited")
+        except APIException as e:
+            if not refused(e):
+                raise
+            # Deleted message, missing permissions, etc. Retrying won't help.
+            self.log.info(f"End action for message {data['mid']} in {data['cid']} was refused: {e.msg}")
+
+    def render_notification(self, stream, enabled_components, renders):
+        """
+        Builds the embed and watch button for a stream once per set of enabled components, configs sharing the same
+        components reuse the render. Returns the embed, serialized components and a hash of both.
+        """
+        key = (stream['user_id'], RENDERED_COMPONENTS.intersection(enabled_components))
+        if key in renders:
+            return renders[key]
+
+        embed = self.build_message_embed(enabled_components, stream)
+        components = None
+        if 'button' in enabled_components:
+            main_ar = ActionRow()
+            preview_btn = ButtonComponent(get_component_template("stream_notification_url_button"))
+            preview_btn.url = f"https://twitch.tv/{stream['user_login']}"
+            if 'mature_badge' in enabled_components:
+                preview_btn.label += "🔞"
+            main_ar.add_component(preview_btn)
+            components = [main_ar.to_dict()]
+
+        raw = json.dumps({'embed': embed.to_dict(), 'components': components}, sort_keys=True, default=str)
+        renders[key] = (embed, components, hashlib.sha1(raw.encode('utf-8')).hexdigest())
+        return renders[key]
 
     def configure_stream(self, event, msg, streamer, initial_setup=False, stream_cfg=None, promo_setup=False):
 
         current_working_event = event
         dl_button_pressed = False
         gcfg, created = GuildConfigs.get_or_create(guild_id=event.guild.id)
+        if created:
+            guild_configs.invalidate(event.guild.id)
         selected_channel = None
         enabled_components = []
         error = ""
@@ -509,6 +882,7 @@ class AnnouncementPlugin(Plugin):
                             gcfg.config.promotional_settings.promo_channel = selected_channel
                             gcfg.config.promotional_settings.promo_config = config
                             gcfg.save()
+                            guild_configs.invalidate(gcfg.guild_id)
                             msg.edit(
                                 f"Promo Template Saved.").after(30)
                             msg.delete()
@@ -521,6 +895,7 @@ class AnnouncementPlugin(Plugin):
                                 StreamConfigs.notification_channel: selected_channel,
                                 StreamConfigs.notification_role: role
                             }).where(StreamConfigs.id == stream_cfg.id).execute()
+                            stream_configs.invalidate()
                         else:
                             StreamConfigs.create(guild_id=current_working_event.guild.id,
                                                  notification_channel=selected_channel,
@@ -529,6 +904,7 @@ class AnnouncementPlugin(Plugin):
                                                  streamer_name=streamer['login'],
                                                  config=config.to_dict(),
                                                  messages=[message])
+                            stream_configs.invalidate()
 
                         msg.edit(f"Config saved for streamer `{streamer['display_name']}` (<#{selected_channel}>)").after(30)
                         msg.delete()
@@ -570,6 +946,7 @@ class AnnouncementPlugin(Plugin):
                             continue
 
                         StreamConfigs.delete().where(StreamConfigs.id == stream_cfg.id).execute()
+                        stream_configs.invalidate()
                         msg.edit("💩 Config Deleted.").after(10)
                         msg.delete()
                         return
@@ -747,7 +1124,7 @@ class AnnouncementPlugin(Plugin):
                     ar.add_component(confirm_yes)
                     ar.add_component(confirm_no)
 
-                    if rjson.get("data"):
+                    if rjson and rjson.get("data"):
                         if len(rjson["data"]) == 0:
 
                             msg.edit(f"**Error**: There is no twitch user with the username `{submitted}`. Would you like to retry?", components=[ar.to_dict()])
@@ -773,7 +1150,7 @@ class AnnouncementPlugin(Plugin):
                             embed = MessageEmbed(get_embed_template("stream_user_confirmation"))
                             tmp_desc = embed.description
                             tmp_desc = tmp_desc.replace("{display_name}", rjson["data"][0]["display_name"])
-                            tmp_desc = tmp_desc.replace("{followers}", str(sjson["total"]))
+                            tmp_desc = tmp_desc.replace("{followers}", str(sjson["total"]) if sjson else "N/A")
                             # tmp_desc = tmp_desc.replace("{title}", f"*{rjson['data'][0]['type']}*")
                             embed.description = tmp_desc.replace("{description}", f"{rjson['data'][0]['description']}")
                             embed.set_thumbnail(url=rjson["data"][0]["profile_image_url"])
@@ -807,6 +1184,34 @@ class AnnouncementPlugin(Plugin):
             msg.edit("Timed out.").after(10)
             msg.delete()
 
+    @Plugin.listen("InteractionCreate", conditional=lambda e: e.type == InteractionType.APPLICATION_COMMAND and e.data.name == "tavern-stats")
+    def stats_cmd(self, event):
+        traces = load_traces()
+
+        embed = MessageEmbed()
+        embed.color = 0x8503d1
+        embed.title = "Go Live Latency"
+        embed.description = f"Last `{len(traces)}` traced announcements, checking every `{bot_config.check_interval}s`."
+
+        def fmt(values):
+            points = percentiles(values)
+            if points[50] is None:
+                return "`No data`"
+            return "\n".join(f"p{point}: `{value:.1f}s`" for point, value in points.items())
+
+        embed.add_field(name="Detection", value=fmt([t.detection for t in traces]), inline=True)
+        embed.add_field(name="Sending", value=fmt([t.send for t in traces]), inline=True)
+        embed.add_field(name="Delivery", value=fmt([t.delivery for t in traces]), inline=True)
+
+        by_source = {}
+        for trace in traces:
+            by_source.setdefault(trace.source, []).append(trace.delivery)
+        for source, values in sorted(by_source.items()):
+            embed.add_field(name=f"Delivery ({source})", value=fmt(values), inline=True)
+
+        embed.set_footer(text="Detection: stream start to us noticing. Delivery: stream start to the message being sent.")
+        event.reply(type=4, embeds=[embed], flags=(1 << 6))
+
     @Plugin.listen("InteractionCreate", conditional=lambda e: e.type == InteractionType.APPLICATION_COMMAND_AUTOCOMPLETE and e.data.name == "configure-streams")
     def streamer_autocomplete(self, event):
         choices = []
@@ -836,8 +1241,12 @@ class AnnouncementPlugin(Plugin):
     @Plugin.listen("MessageCreate", conditional=lambda e: not e.author.bot and e.guild is not None)
     def promotional_messages(self, event):
 
+        # Most messages aren't in a promo channel, turn them away before anything else.
+        if not guild_configs.is_promo_channel(event.channel.id):
+            return
+
         # Grab config for guild, if there is one. If not, ignore!
-        guild_config = GuildConfigs.get(guild_id=event.guild.id)
+        guild_config = guild_configs.get(event.guild.id)
 
         if not guild_config:
             return
@@ -865,22 +1274,21 @@ class AnnouncementPlugin(Plugin):
         new_content = event.content.replace(user_url_to_convert, f"<{user_url_to_convert}>", -1)
 
         # Check if the user is actually live...and actually exists...!
-        resp_code, rjson = make_twitch_request("https://api.twitch.tv/helix/streams", "GET",
-                                               params={'user_login': user.lower(), 'type': "live"})
+        stream = live_stream_cache.get_by_login(user)
 
-        if not rjson.get("data") or len(rjson['data']) == 0:
+        if not stream:
             return
 
         # Let's craft that message!
         enabled_components = [cp for cp, value in guild_config.config.promotional_settings.promo_config.to_dict().items() if value == True]
-        embed = self.build_message_embed(enabled_components, rjson["data"][0])
+        embed = self.build_message_embed(enabled_components, stream)
         embed.set_footer(icon_url=event.author.avatar_url, text=f"Promoted by {event.author.username}")
         components = None
         if 'button' in enabled_components:
             main_ar = ActionRow()
             preview_btn = component(get_component_template("stream_notification_url_button"))
             preview_btn.url = user_url_to_convert
-            if rjson['data'][0]['is_mature']:
+            if stream['is_mature']:
                 preview_btn.label += "🔞"
             main_ar.add_component(preview_btn)
             components = [main_ar]
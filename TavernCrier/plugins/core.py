@@ -1,5 +1,3 @@
-import gevent
-import requests
 import yaml
 from disco.bot.plugin import Plugin
 from disco.types.message import MessageEmbed
@@ -7,36 +5,32 @@ from disco.util.emitter import Priority
 
 from TavernCrier import config
 from TavernCrier.redis import rdb
-from TavernCrier.util.twitch import refresh_access_token
+from TavernCrier.util.metrics import serve_metrics
+from TavernCrier.util.twitch import twitch
 
 
 class CorePlugin(Plugin):
     def load(self, ctx):
-        # Check for and validate twitch access token
-        if rdb.get("twitch_access_token"):
-            req = requests.get("https://id.twitch.tv/oauth/validate",
-                               headers={'Authorization': f"OAuth {rdb.get('twitch_access_token')}"})
-            if req.status_code == 401:
-                success, expire = refresh_access_token()
-                if not success:
-                    self.log.error("BOIS, SOMETHING IS ON FIRE 🔥 SEND HELP!")
-        else:
-            self.log.info("Token not found in redis, attempting to refresh")
-            success, expire = refresh_access_token()
+        # Check for and validate twitch access token. The client fetches one if there isn't any, and a token that
+        # fails validation is dropped, the next request refreshes it.
+        status = twitch.validate_access_token()
+        if status is None:
+            self.log.error("BOIS, SOMETHING IS ON FIRE 🔥 SEND HELP!")
+        elif status == 401:
+            self.log.info("Twitch access token is no longer valid, it'll be refreshed on the next request")
 
         super(CorePlugin, self).load(ctx)
 
+        metrics_config = config.get('metrics') or {}
+        if metrics_config.get('enabled'):
+            self.spawn(serve_metrics, metrics_config.get('host', "127.0.0.1"), metrics_config.get('port', 9108))
+
     # TODO: Bot startup log
     @Plugin.listen("Ready")
     def on_ready(self, event):
         if self.bot.client.gw.reconnects:
-            self.log.info("[Bot GW Reconnect] Restarting live schedule.")
-            active_greenlet = self.bot.plugins["AnnouncementPlugin"].schedules['stream_grab_schedule']
-            del self.bot.plugins["AnnouncementPlugin"].schedules['stream_grab_schedule']
-            gevent.sleep(10)
-            self.bot.plugins["AnnouncementPlugin"].register_schedule(self.bot.plugins["AnnouncementPlugin"].stream_grab_schedule, config.check_interval, init=True)
-            self.log.info("[Bot GW Reconnect] Live schedule restarted.")
-            active_greenlet.kill()
+            # The poll loop doesn't depend on the gateway, so there's nothing to restart.
+            self.log.info("[Bot GW Reconnect] Reconnected.")
         else:
             self.log.info(f"Logged into discord as {event.user}")
             self.log.info("Updating registered commands...")
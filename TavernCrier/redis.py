@@ -1,6 +1,28 @@
 import redis
+from redis.client import Pipeline
 
 from TavernCrier import config
+from TavernCrier.util.metrics import REDIS_COMMAND_SECONDS
 
-rdb = redis.Redis(host=config.database_info['redis']['host'], port=config.database_info['redis']['port'],
-                  db=config.database_info['redis']['db'], decode_responses=True)
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        with REDIS_COMMAND_SECONDS.time(command="MULTI" if self.transaction else "PIPELINE"):
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    Times every command, and every pipeline as a whole.
+    """
+
+    def execute_command(self, *args, **options):
+        with REDIS_COMMAND_SECONDS.time(command=str(args[0]).upper()):
+            return super(InstrumentedRedis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+rdb = InstrumentedRedis(host=config.database_info['redis']['host'], port=config.database_info['redis']['port'],
+                        db=config.database_info['redis']['db'], decode_responses=True)
@@ -0,0 +1,135 @@
+import time
+from datetime import datetime, timezone
+
+from TavernCrier.redis import rdb
+from TavernCrier.util.state import stream_history_key
+from TavernCrier.util.twitch import HELIX_MAX_IDS
+
+HOURS_PER_WEEK = 168
+WEEK = 604800
+
+
+def hour_of_week(timestamp) -> int:
+    dt = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    return dt.weekday() * 24 + dt.hour
+
+
+class StreamerProfile(object):
+    """
+    How often a streamer has been live during each hour of the week, built from their go live/offline history.
+    """
+    __slots__ = ('sessions', 'weeks', 'coverage')
+
+    def __init__(self, history):
+        self.sessions = 0
+        self.coverage = [0] * HOURS_PER_WEEK
+
+        oldest = newest = None
+        started = None
+        # History is newest first
+        for entry in reversed(history):
+            event, _, timestamp = entry.partition(":")
+            timestamp = float(timestamp)
+            oldest = timestamp if oldest is None else oldest
+            newest = timestamp
+
+            if event == "online":
+                started = timestamp
+            elif event == "offline" and started is not None:
+                self.sessions += 1
+                # Cap it at a day, in case we missed an offline somewhere.
+                for hour in range(int(started // 3600), int(min(timestamp, started + 86400) // 3600) + 1):
+                    self.coverage[hour_of_week(hour * 3600)] += 1
+                started = None
+
+        self.weeks = max((newest - oldest) / WEEK, 1) if oldest is not None else 1
+
+    def likelihood(self, timestamp) -> float:
+        """
+        Rough chance the streamer is live around the given time, going by how many weeks they were live in the
+        surrounding hours.
+        """
+        hour = hour_of_week(timestamp)
+        covered = max(self.coverage[(hour + offset) % HOURS_PER_WEEK] for offset in (-1, 0, 1))
+        return min(covered / self.weeks, 1.0)
+
+
+class AdaptivePollScheduler(object):
+    """
+    Picks which streamers are polled each tick. Live streamers, and ones that are usually live around now, are
+    polled every tick. Everyone else is polled less often the less likely they are to be live, down to once every
+    `max_interval` seconds. Streamers without `min_history` recorded streams are always polled.
+
+    At most `max_requests` Helix requests are made per tick. Since a request costs the same for 1 or 100 streamers,
+    any room left in the last batch is filled with whoever is closest to being due.
+    """
+
+    def __init__(self, min_interval, max_interval=300, threshold=0.25, min_history=3, max_requests=10,
+                 history_size=100):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.threshold = threshold
+        self.min_history = min_history
+        self.max_requests = max_requests
+        self.history_size = history_size
+
+        self.profiles = {}
+        self.last_polled = {}
+        self.selected_at = None
+
+    def _load_profiles(self, user_ids):
+        missing = [user_id for user_id in user_ids if user_id not in self.profiles]
+        if not missing:
+            return
+
+        pipe = rdb.pipeline(transaction=False)
+        for user_id in missing:
+            pipe.lrange(stream_history_key(user_id), 0, self.history_size - 1)
+
+        for user_id, history in zip(missing, pipe.execute()):
+            self.profiles[user_id] = StreamerProfile(history)
+
+    def forget(self, user_id):
+        self.profiles.pop(user_id, None)
+
+    def likelihood(self, user_id, now) -> float | None:
+        profile = self.profiles.get(user_id)
+        if not profile or profile.sessions < self.min_history:
+            return None
+        return profile.likelihood(now)
+
+    def interval(self, user_id, now, live) -> float:
+        likelihood = self.likelihood(user_id, now)
+        if live or likelihood is None or likelihood >= self.threshold:
+            return self.min_interval
+
+        return self.min_interval + (self.max_interval - self.min_interval) * (1 - likelihood / self.threshold)
+
+    def select(self, user_ids, live_ids, now=None) -> set:
+        now = now or time.time()
+        self.selected_at = now
+        user_ids = list(user_ids)
+        self._load_profiles(user_ids)
+
+        # How far along each streamer is to being due, 1 or more is due
+        overdue = {}
+        for user_id in user_ids:
+            interval = self.interval(user_id, now, user_id in live_ids)
+            # Half a tick of slack, so someone due every tick isn't skipped because the last tick started a bit late
+            overdue[user_id] = (now - self.last_polled.get(user_id, 0) + self.min_interval / 2) / interval
+
+        ordered = sorted(user_ids, key=lambda u: (overdue[u] < 1, u not in live_ids, -overdue[u]))
+        due = [user_id for user_id in ordered if overdue[user_id] >= 1]
+
+        capacity = self.max_requests * HELIX_MAX_IDS
+        if len(due) >= capacity:
+            return set(due[:capacity])
+
+        # Fill up the last batch for free
+        batches = -(-len(due) // HELIX_MAX_IDS)
+        return set(ordered[:batches * HELIX_MAX_IDS])
+
+    def polled(self, user_ids, now=None):
+        now = now or self.selected_at or time.time()
+        for user_id in user_ids:
+            self.last_polled[user_id] = now
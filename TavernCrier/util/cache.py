@@ -0,0 +1,302 @@
+import time
+from collections import OrderedDict
+
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+
+from TavernCrier.db import postgres_db
+from TavernCrier.models.configs import GuildConfigs
+from TavernCrier.redis import rdb
+from TavernCrier.util.metrics import CACHE_REQUESTS
+from TavernCrier.util.ratelimit import RequestPriority
+from TavernCrier.util.twitch import make_twitch_request, chunk_ids, get_latest_vods, HELIX_STREAMS_URL
+
+
+class StreamConfigIndex(object):
+    """
+    In process copy of every stream config, keyed by streamer_id.
+    Anything writing to `stream_configs` calls `invalidate()`, which bumps a version counter in redis so every
+    bot process reloads on its next lookup. While nothing changes a lookup costs a single redis GET.
+    """
+    VERSION_KEY = "stream_configs:version"
+
+    def __init__(self):
+        self.configs = {}
+        self.version = None
+        self._lock = Semaphore()
+
+    def load(self):
+        version = rdb.get(self.VERSION_KEY) or "0"
+        configs = postgres_db.execute_sql(
+            """
+                SELECT 
+                streamer_id, 
+                array_agg(json_build_object('id', id, 'channel', notification_channel, 'role', notification_role, 'config', config, 'messages', messages)) 
+                FROM stream_configs GROUP BY streamer_name, streamer_id
+            """)
+
+        self.configs = {str(row[0]): row[1] for row in configs}
+        self.version = version
+
+    def get(self) -> dict:
+        with self._lock:
+            if self.version is None or (rdb.get(self.VERSION_KEY) or "0") != self.version:
+                CACHE_REQUESTS.inc(cache="stream_configs", result="miss")
+                self.load()
+            else:
+                CACHE_REQUESTS.inc(cache="stream_configs", result="hit")
+            return self.configs
+
+    def invalidate(self):
+        rdb.incr(self.VERSION_KEY)
+        self.version = None
+
+
+
+class GuildConfigCache(object):
+    """
+    In process copy of every guild config, along with the set of channels that have promotions enabled so that
+    most messages can be turned away without a lookup. Guilds without a row are cached as None.
+    Local saves call `invalidate(guild_id)`, other processes pick the change up through the redis version
+    counter, which is checked at most once every `ttl` seconds.
+    """
+    VERSION_KEY = "guild_configs:version"
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.configs = {}
+        self.promo_channels = set()
+        self.version = None
+        self._checked_at = 0
+
+    def load(self):
+        version = rdb.get(self.VERSION_KEY) or "0"
+        self.configs = {gcfg.guild_id: gcfg for gcfg in GuildConfigs.select()}
+        self._build_promo_channels()
+        self.version = version
+        self._checked_at = time.monotonic()
+
+    def _build_promo_channels(self):
+        self.promo_channels = {
+            gcfg.config.promotional_settings.promo_channel for gcfg in self.configs.values()
+            if gcfg and gcfg.config.promotional_settings.enabled and gcfg.config.promotional_settings.promo_channel
+        }
+
+    def _check_version(self):
+        if self.version is not None and time.monotonic() - self._checked_at < self.ttl:
+            return
+
+        self._checked_at = time.monotonic()
+        if (rdb.get(self.VERSION_KEY) or "0") != self.version:
+            self.load()
+
+    def is_promo_channel(self, channel_id) -> bool:
+        self._check_version()
+        return channel_id in self.promo_channels
+
+    def get(self, guild_id) -> GuildConfigs | None:
+        self._check_version()
+        CACHE_REQUESTS.inc(cache="guild_configs", result="hit" if guild_id in self.configs else "miss")
+        return self.configs.get(guild_id)
+
+    def invalidate(self, guild_id):
+        self.configs[guild_id] = GuildConfigs.get_or_none(guild_id=guild_id)
+        self._build_promo_channels()
+        previous = self.version
+        version = rdb.incr(self.VERSION_KEY)
+        if previous is not None and version == int(previous) + 1:
+            self.version = str(version)
+            self._checked_at = time.monotonic()
+        else:
+            # Someone else saved a guild since we last loaded, only a full reload picks theirs up.
+            self.version = None
+
+
+
+class LiveStreamCache(object):
+    """
+    Short lived cache of Helix stream objects, keyed by both login and user id.
+    The poll tick fills it with every tracked stream it sees live, anything else falls back to Helix, with concurrent
+    misses for the same login sharing one request. Logins Helix reports as offline are cached for `negative_ttl`.
+    Expired entries are swept out at most once every `ttl` seconds.
+    """
+
+    def __init__(self, ttl=60, negative_ttl=30):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._by_login = {}
+        self._by_id = {}
+        self._pending = {}
+        self._pruned_at = time.monotonic()
+
+    def _prune(self, now):
+        # Promos can link any login, without this every one ever linked would stay
+        if now - self._pruned_at < self.ttl:
+            return
+        self._pruned_at = now
+
+        for entries in (self._by_login, self._by_id):
+            for key in [key for key, (_, expires_at) in entries.items() if expires_at <= now]:
+                del entries[key]
+
+    def update(self, streams):
+        now = time.monotonic()
+        self._prune(now)
+        for stream in streams:
+            self._by_login[stream['user_login'].lower()] = (stream, now + self.ttl)
+            self._by_id[stream['user_id']] = (stream, now + self.ttl)
+
+    def discard(self, user_id):
+        entry = self._by_id.pop(user_id, None)
+        if entry and entry[0]:
+            self._by_login.pop(entry[0]['user_login'].lower(), None)
+
+    def get_by_id(self, user_id):
+        entry = self._by_id.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    def get_by_login(self, login):
+        login = login.lower()
+        entry = self._by_login.get(login)
+        if entry and entry[1] > time.monotonic():
+            CACHE_REQUESTS.inc(cache="live_streams", result="hit")
+            return entry[0]
+        CACHE_REQUESTS.inc(cache="live_streams", result="miss")
+
+        if login in self._pending:
+            return self._pending[login].get()
+
+        result = self._pending[login] = AsyncResult()
+        try:
+            code, rjson = make_twitch_request(HELIX_STREAMS_URL, "GET", params={'user_login': login, 'type': "live"})
+            stream = rjson['data'][0] if rjson and rjson.get('data') else None
+            if stream:
+                self.update([stream])
+            elif code == 200:
+                now = time.monotonic()
+                self._prune(now)
+                self._by_login[login] = (None, now + self.negative_ttl)
+            result.set(stream)
+            return stream
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        finally:
+            del self._pending[login]
+
+
+
+class AvatarResolver(object):
+    """
+    Streamer avatars, from a bounded in process LRU backed by the `avatar_cache:{user_id}` keys in redis.
+    Misses are fetched from helix/users in batches of up to 100, and users Twitch doesn't know about are cached
+    as an empty string for `negative_ttl` seconds. LRU entries expire along with their redis key, an expired
+    avatar is still handed out if looking it up again fails.
+    """
+
+    def __init__(self, size=2048, ttl=259200, negative_ttl=3600):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # user_id: (url, expires_at)
+        self._lru = OrderedDict()
+
+    def _remember(self, user_id, url, ttl):
+        self._lru[user_id] = (url, time.monotonic() + ttl)
+        self._lru.move_to_end(user_id)
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    def _fresh(self, user_id, now) -> bool:
+        entry = self._lru.get(user_id)
+        return entry is not None and entry[1] > now
+
+    def prefetch(self, user_ids, priority=RequestPriority.USER):
+        now = time.monotonic()
+        user_ids = {str(user_id) for user_id in user_ids}
+        missing = [user_id for user_id in user_ids if not self._fresh(user_id, now)]
+        CACHE_REQUESTS.inc(len(user_ids) - len(missing), cache="avatars", result="hit")
+        if not missing:
+            return
+
+        pipe = rdb.pipeline(transaction=False)
+        for user_id in missing:
+            pipe.get(f'avatar_cache:{user_id}')
+            pipe.ttl(f'avatar_cache:{user_id}')
+        results = pipe.execute()
+        for user_id, url, ttl in zip(missing, results[::2], results[1::2]):
+            if url is not None:
+                # -1 is a key without an expiry
+                self._remember(user_id, url, ttl if ttl > 0 else self.ttl if url else self.negative_ttl)
+                CACHE_REQUESTS.inc(cache="avatars", result="redis")
+
+        missing = [user_id for user_id in missing if not self._fresh(user_id, now)]
+        CACHE_REQUESTS.inc(len(missing), cache="avatars", result="miss")
+        for batch in chunk_ids(missing):
+            code, ujson = make_twitch_request("https://api.twitch.tv/helix/users", "GET",
+                                              params=[('id', user_id) for user_id in batch], priority=priority)
+            if code != 200:
+                continue
+
+            found = {user['id']: user['profile_image_url'] for user in (ujson or {}).get('data') or []}
+            pipe = rdb.pipeline(transaction=False)
+            for user_id in batch:
+                url = found.get(user_id, "")
+                ttl = self.ttl if url else self.negative_ttl
+                pipe.set(f'avatar_cache:{user_id}', url, ex=ttl)
+                self._remember(user_id, url, ttl)
+            pipe.execute()
+
+    def get(self, user_id) -> str | None:
+        user_id = str(user_id)
+        if not self._fresh(user_id, time.monotonic()):
+            self.prefetch([user_id])
+
+        entry = self._lru.get(user_id)
+        if entry is None:
+            return None
+        self._lru.move_to_end(user_id)
+        return entry[0] or None
+
+
+class VodCache(object):
+    """
+    Latest archived broadcasts per streamer for end of stream actions. A streamer announced in several guilds ends
+    in several jobs at once, they share one helix/videos lookup.
+    """
+
+    def __init__(self, ttl=120):
+        self.ttl = ttl
+        self._vods = {}
+        self._pending = {}
+
+    def get(self, user_id) -> list:
+        entry = self._vods.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            CACHE_REQUESTS.inc(cache="vods", result="hit")
+            return entry[0]
+        CACHE_REQUESTS.inc(cache="vods", result="miss")
+
+        if user_id in self._pending:
+            return self._pending[user_id].get()
+
+        result = self._pending[user_id] = AsyncResult()
+        try:
+            vods = get_latest_vods([user_id]).get(user_id) or []
+            self._vods[user_id] = (vods, time.monotonic() + self.ttl)
+            result.set(vods)
+            return vods
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        finally:
+            del self._pending[user_id]
+
+
+stream_configs = StreamConfigIndex()
+guild_configs = GuildConfigCache()
+live_stream_cache = LiveStreamCache()
+avatars = AvatarResolver()
+vods = VodCache()
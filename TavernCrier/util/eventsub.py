@@ -0,0 +1,170 @@
+import json
+import logging
+import random
+from collections import deque
+
+import gevent
+import websocket
+from gevent.lock import Semaphore
+
+from TavernCrier.util.ratelimit import RequestPriority
+from TavernCrier.util.twitch import make_twitch_request
+
+EVENTSUB_SUBSCRIPTIONS_URL = "https://api.twitch.tv/helix/eventsub/subscriptions"
+
+log = logging.getLogger(__name__)
+
+
+class EventSubClient(object):
+    """
+    Twitch EventSub over WebSocket, subscribed to `stream.online`/`stream.offline` for every streamer
+    returned by `streamer_ids`. Subscriptions are kept in sync every `sync_interval` seconds.
+
+    Twitch caps how many subscriptions a single connection may hold, streamers we fail to subscribe to are
+    left in `unsubscribed` so the poller can keep an eye on them.
+    """
+    URL = "wss://eventsub.wss.twitch.tv/ws"
+    SUBSCRIPTION_TYPES = ("stream.online", "stream.offline")
+
+    def __init__(self, streamer_ids, on_online, on_offline, url=URL, sync_interval=30):
+        self.streamer_ids = streamer_ids
+        self.on_online = on_online
+        self.on_offline = on_offline
+        self.url = url
+        self.sync_interval = sync_interval
+
+        self.ws = None
+        self.session_id = None
+        self.keepalive_timeout = 10
+        self.subscriptions = {}
+        self.unsubscribed = set()
+        self._seen_messages = deque(maxlen=512)
+        self._sync_lock = Semaphore()
+
+    @property
+    def connected(self):
+        return self.session_id is not None
+
+    def run(self):
+        backoff = 1
+        while True:
+            try:
+                self._connect(self.url)
+                backoff = 1
+                self._read_loop()
+            except Exception as e:
+                log.warning("EventSub connection lost, reconnecting in %ss: %s", backoff, e)
+
+            # Subscriptions belong to the session, a new session starts from scratch.
+            self.session_id = None
+            self.subscriptions.clear()
+            self._close()
+            gevent.sleep(backoff + random.random())
+            backoff = min(backoff * 2, 60)
+
+    def sync_loop(self):
+        while True:
+            gevent.sleep(self.sync_interval)
+            if not self.connected:
+                continue
+            try:
+                self.sync()
+            except Exception:
+                log.exception("Failed to sync EventSub subscriptions")
+
+    def _close(self):
+        if self.ws:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+            self.ws = None
+
+    def _connect(self, url):
+        ws = websocket.create_connection(url, timeout=30)
+        welcome = json.loads(ws.recv())
+        if welcome['metadata']['message_type'] != "session_welcome":
+            ws.close()
+            raise ValueError(f"Expected session_welcome, got {welcome['metadata']['message_type']}")
+
+        session = welcome['payload']['session']
+        reconnecting = self.session_id is not None
+
+        self._close()
+        self.ws = ws
+        self.session_id = session['id']
+        self.keepalive_timeout = session.get('keepalive_timeout_seconds') or 10
+        self.ws.settimeout(self.keepalive_timeout + 5)
+
+        # Subscriptions carry over when Twitch asks us to reconnect.
+        if not reconnecting:
+            gevent.spawn(self.sync)
+
+    def _read_loop(self):
+        while True:
+            message = json.loads(self.ws.recv())
+            metadata = message['metadata']
+
+            if metadata['message_id'] in self._seen_messages:
+                continue
+            self._seen_messages.append(metadata['message_id'])
+
+            match metadata['message_type']:
+                case "notification":
+                    subscription = message['payload']['subscription']
+                    event = message['payload']['event']
+                    if subscription['type'] == "stream.online":
+                        gevent.spawn(self.on_online, event, metadata['message_timestamp'])
+                    elif subscription['type'] == "stream.offline":
+                        gevent.spawn(self.on_offline, event, metadata['message_timestamp'])
+                case "session_reconnect":
+                    self._connect(message['payload']['session']['reconnect_url'])
+                case "revocation":
+                    subscription = message['payload']['subscription']
+                    user_id = subscription['condition'].get('broadcaster_user_id')
+                    self.subscriptions.pop((subscription['type'], user_id), None)
+                    log.warning("EventSub subscription %s for %s revoked: %s", subscription['type'], user_id,
+                                subscription['status'])
+                case _:
+                    # session_keepalive, nothing to do but reset the read timeout.
+                    pass
+
+    def sync(self):
+        """
+        Subscribes to whoever's missing and drops subscriptions nobody wants. Called on connect, from `sync_loop` and
+        when leadership changes, one at a time, otherwise two syncs would both subscribe the same streamer and one
+        would get a 409.
+        """
+        with self._sync_lock:
+            self._sync()
+
+    def _sync(self):
+        session_id = self.session_id
+        if not session_id:
+            return
+
+        wanted = {(sub_type, str(user_id)) for user_id in self.streamer_ids() for sub_type in self.SUBSCRIPTION_TYPES}
+
+        for sub_type, user_id in wanted - set(self.subscriptions):
+            code, rjson = make_twitch_request(EVENTSUB_SUBSCRIPTIONS_URL, "POST", body={
+                'type': sub_type,
+                'version': "1",
+                'condition': {'broadcaster_user_id': user_id},
+                'transport': {'method': "websocket", 'session_id': session_id}
+            }, priority=RequestPriority.POLL)
+
+            if session_id != self.session_id:
+                return
+
+            if code == 202 and rjson and rjson.get('data'):
+                self.subscriptions[(sub_type, user_id)] = rjson['data'][0]['id']
+            else:
+                log.warning("Unable to subscribe to %s for %s (%s)", sub_type, user_id, code)
+
+        for key in set(self.subscriptions) - wanted:
+            code, rjson = make_twitch_request(EVENTSUB_SUBSCRIPTIONS_URL, "DELETE",
+                                              params={'id': self.subscriptions[key]}, priority=RequestPriority.POLL)
+            if code in (204, 404):
+                self.subscriptions.pop(key, None)
+
+        self.unsubscribed = {user_id for (sub_type, user_id) in wanted - set(self.subscriptions)}
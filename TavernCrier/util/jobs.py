@@ -0,0 +1,207 @@
+import json
+import logging
+import random
+import time
+import uuid
+
+import gevent
+from gevent.event import Event
+
+from TavernCrier.redis import rdb
+
+log = logging.getLogger(__name__)
+
+# Queues a job unless its idempotency key has been seen within the TTL. The key holds the job's id until it's sent.
+ENQUEUE_SCRIPT = rdb.register_script("""
+if redis.call('SET', KEYS[2], ARGV[3], 'NX', 'EX', ARGV[2]) then
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+    return 1
+end
+return 0
+""")
+
+# Moves due retries and expired claims back onto the ready list, then claims the next job until `now + ARGV[2]`.
+CLAIM_SCRIPT = rdb.register_script("""
+local now = tonumber(ARGV[1])
+for _, key in ipairs({KEYS[2], KEYS[3]}) do
+    for _, job in ipairs(redis.call('ZRANGEBYSCORE', key, '-inf', now, 'LIMIT', 0, 100)) do
+        redis.call('ZREM', key, job)
+        redis.call('RPUSH', KEYS[1], job)
+    end
+end
+local job = redis.call('LPOP', KEYS[1])
+if job then
+    redis.call('ZADD', KEYS[3], now + tonumber(ARGV[2]), job)
+end
+return job
+""")
+
+
+class JobFailed(Exception):
+    """
+    Raised by a handler when retrying a job won't help, the job goes straight to the dead letter list.
+    """
+
+
+class OutboundQueue(object):
+    """
+    Durable redis queue of outbound calls, worked through by a pool of worker greenlets.
+
+    Jobs are pushed on a pipeline so they can be queued in the same transaction as the state change that created
+    them. A claimed job stays in the `inflight` set until it's handled, one whose worker died is handed out again
+    after `visibility_timeout` seconds. Failed jobs are retried with jittered exponential backoff from the `delayed`
+    set, up to `max_attempts` times, before landing on the `dead` list.
+
+    Jobs pushed with an idempotency key are only queued once per key within `idempotency_ttl` seconds. The key
+    holds the id of the job queued under it, then "sent" once that job succeeds, and a job is skipped if its key
+    has moved on to "sent" or another job.
+    """
+
+    def __init__(self, prefix, workers=10, max_attempts=6, backoff_base=2, backoff_max=300, visibility_timeout=300,
+                 idempotency_ttl=86400, dead_letter_size=1000, poll_interval=1):
+        self.prefix = prefix
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.visibility_timeout = visibility_timeout
+        self.idempotency_ttl = idempotency_ttl
+        self.dead_letter_size = dead_letter_size
+        self.poll_interval = poll_interval
+
+        self.ready_key = f"{prefix}:ready"
+        self.delayed_key = f"{prefix}:delayed"
+        self.inflight_key = f"{prefix}:inflight"
+        self.dead_key = f"{prefix}:dead"
+
+        self.handlers = {}
+        self._wakeup = Event()
+
+    def handler(self, job_type, func):
+        """
+        Registers `func(job)` to handle jobs of `job_type`. The job's payload is in `job['data']`.
+        """
+        self.handlers[job_type] = func
+
+    def idempotency_key(self, key):
+        return f"{self.prefix}:key:{key}"
+
+    def push(self, pipe, job_type, data, key=None) -> str:
+        """
+        Returns the new job's id. With a `key` the job may not have been queued, anything written alongside it
+        that relies on the job should check the key holds the id, see `state.set_pending_live_update`.
+        """
+        job_id = uuid.uuid4().hex
+        job = json.dumps({'id': job_id, 'type': job_type, 'key': key, 'data': data, 'attempts': 0,
+                          'queued_at': time.time()})
+        if key is None:
+            pipe.rpush(self.ready_key, job)
+        else:
+            ENQUEUE_SCRIPT(keys=[self.ready_key, self.idempotency_key(key)], args=[job, self.idempotency_ttl, job_id],
+                           client=pipe)
+        return job_id
+
+    def forget(self, pipe, key):
+        """
+        Allows a job with `key` to be queued and delivered again.
+        """
+        pipe.unlink(self.idempotency_key(key))
+
+    def notify(self):
+        """
+        Wakes idle workers in this process, call after executing a pipeline jobs were pushed on.
+        """
+        self._wakeup.set()
+
+    def metrics(self) -> dict:
+        pipe = rdb.pipeline(transaction=False)
+        pipe.llen(self.ready_key)
+        pipe.zcard(self.delayed_key)
+        pipe.zcard(self.inflight_key)
+        pipe.llen(self.dead_key)
+        ready, delayed, inflight, dead = pipe.execute()
+        return {'ready': ready, 'delayed': delayed, 'inflight': inflight, 'dead': dead}
+
+    def work(self):
+        while True:
+            try:
+                raw = CLAIM_SCRIPT(keys=[self.ready_key, self.delayed_key, self.inflight_key],
+                                   args=[time.time(), self.visibility_timeout])
+            except Exception:
+                log.exception("Unable to claim an outbound job")
+                gevent.sleep(self.poll_interval)
+                continue
+
+            if raw is None:
+                self._wakeup.clear()
+                self._wakeup.wait(timeout=self.poll_interval)
+                continue
+
+            try:
+                self._run(raw)
+            except Exception:
+                # The job stays inflight, it's claimed again once its visibility timeout passes.
+                log.exception("Unable to run an outbound job")
+                gevent.sleep(self.poll_interval)
+
+    def _run(self, raw):
+        job = json.loads(raw)
+        started = time.perf_counter()
+        try:
+            # Keys queued before they held job ids say "queued", a missing key was forgotten or expired.
+            if job['key'] and rdb.get(self.idempotency_key(job['key'])) not in (None, "queued", job['id']):
+                self._ack(raw, job, "outbound_duplicates")
+                return
+
+            handler = self.handlers.get(job['type'])
+            if handler is None:
+                raise JobFailed(f"No handler registered for {job['type']}")
+            handler(job)
+        except JobFailed as e:
+            job['attempts'] += 1
+            self._dead(raw, job, e)
+        except Exception as e:
+            self._retry(raw, job, e)
+        else:
+            self._ack(raw, job, "outbound_sent")
+            log.debug("Sent %s job %s in %.2fs", job['type'], job['id'], time.perf_counter() - started)
+
+    def _ack(self, raw, job, stat):
+        pipe = rdb.pipeline()
+        pipe.zrem(self.inflight_key, raw)
+        if job['key']:
+            # A key forgotten while the job ran stays forgotten
+            pipe.set(self.idempotency_key(job['key']), "sent", ex=self.idempotency_ttl, xx=True)
+        pipe.hincrby("stats", stat, 1)
+        pipe.execute()
+
+    def backoff(self, attempts) -> float:
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        return delay / 2 + random.random() * delay / 2
+
+    def _retry(self, raw, job, exception):
+        job['attempts'] += 1
+        if job['attempts'] >= self.max_attempts:
+            self._dead(raw, job, exception)
+            return
+
+        delay = self.backoff(job['attempts'])
+        log.warning("%s job %s failed (attempt %s), retrying in %.1fs: %s", job['type'], job['id'], job['attempts'],
+                    delay, exception)
+
+        pipe = rdb.pipeline()
+        pipe.zrem(self.inflight_key, raw)
+        pipe.zadd(self.delayed_key, {json.dumps(job): time.time() + delay})
+        pipe.hincrby("stats", "outbound_retried", 1)
+        pipe.execute()
+
+    def _dead(self, raw, job, exception):
+        log.error("%s job %s failed for good after %s attempts: %s", job['type'], job['id'], job['attempts'],
+                  exception)
+
+        pipe = rdb.pipeline()
+        pipe.zrem(self.inflight_key, raw)
+        pipe.lpush(self.dead_key, json.dumps(dict(job, error=str(exception), failed_at=time.time())))
+        pipe.ltrim(self.dead_key, 0, self.dead_letter_size - 1)
+        pipe.hincrby("stats", "outbound_dead", 1)
+        pipe.execute()
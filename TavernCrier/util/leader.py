@@ -0,0 +1,105 @@
+import logging
+import os
+import socket
+import time
+import uuid
+
+import gevent
+from redis.exceptions import WatchError
+
+from TavernCrier.redis import rdb
+from TavernCrier.util.shard import RELEASE_SCRIPT, LostOwnership
+
+log = logging.getLogger(__name__)
+
+# Takes or renews the lease for ARGV[1]. Returns the fencing token it's held under, 0 if someone else holds it.
+# Every new holder bumps the token, renewals keep it.
+ELECT_SCRIPT = rdb.register_script("""
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return tonumber(redis.call('GET', KEYS[2]))
+elseif not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return redis.call('INCR', KEYS[2])
+end
+return 0
+""")
+
+
+class NotLeader(LostOwnership):
+    pass
+
+
+class LeaderElection(object):
+    """
+    Picks one process out of everyone sharing redis to run the singleton jobs, through a lease on `key` renewed
+    every `renew_interval` seconds. A standby takes over within `lease_ttl` seconds of the leader going away.
+
+    Each new leader gets a higher fencing token. Transactions written on behalf of the leader go through `fence()`,
+    so a leader that lost its lease without noticing (a long GC pause, a partition) can't commit anything once
+    someone else has taken over.
+    """
+
+    def __init__(self, key, lease_ttl=10, renew_interval=3, on_elected=None):
+        self.key = key
+        self.token_key = f"{key}:token"
+        self.lease_ttl = lease_ttl
+        self.renew_interval = renew_interval
+        self.on_elected = on_elected
+
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.token = None
+        self.renewed_at = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None and time.monotonic() - self.renewed_at < self.lease_ttl - self.renew_interval
+
+    def elect(self):
+        started = time.monotonic()
+        token = ELECT_SCRIPT(keys=[self.key, self.token_key], args=[self.worker_id, int(self.lease_ttl * 1000)])
+
+        if not token:
+            if self.token is not None:
+                log.warning("Lost leadership of %s to %s", self.key, rdb.get(self.key))
+            self.token = None
+            return
+
+        elected = token != self.token
+        self.token = token
+        self.renewed_at = started
+        if elected:
+            log.info("Elected leader of %s (token %s)", self.key, token)
+            if self.on_elected:
+                gevent.spawn(self.on_elected)
+
+    def run(self):
+        while True:
+            try:
+                self.elect()
+            except Exception:
+                log.exception("Leader election for %s failed", self.key)
+            gevent.sleep(self.renew_interval)
+
+    def fence(self, pipe):
+        """
+        Starts a transaction on `pipe` that only commits while our fencing token is still the current one, raises
+        NotLeader if it already isn't.
+        """
+        pipe.watch(self.token_key)
+        if not self.is_leader or pipe.get(self.token_key) != str(self.token):
+            pipe.reset()
+            raise NotLeader(f"Not the leader of {self.key}")
+        pipe.multi()
+
+    def execute(self, pipe):
+        try:
+            return pipe.execute()
+        except WatchError:
+            raise NotLeader(f"Leadership of {self.key} changed before the transaction committed")
+
+    def resign(self):
+        if self.token is not None:
+            RELEASE_SCRIPT(keys=[self.key], args=[self.worker_id])
+        self.token = None
@@ -0,0 +1,108 @@
+import logging
+import math
+import random
+import time
+
+import gevent
+
+from TavernCrier.redis import rdb
+from TavernCrier.util.metrics import POLL_TICK_SECONDS, POLL_TICK_LAG_SECONDS, POLL_TICKS_MISSED, POLL_TICK_FAILURES
+
+log = logging.getLogger(__name__)
+
+
+class PollLoop(object):
+    """
+    Calls `func` every `interval` seconds from a single greenlet, so there's never more than one tick in flight.
+
+    A tick that runs over the interval doesn't queue up the ticks it missed, they're counted and skipped and the loop
+    carries on from the next slot. A tick that raises or returns False counts as failed, the next one is pushed back
+    by a jittered exponential backoff (capped at `max_backoff`) instead of running on schedule. Ticks taking longer
+    than `timeout` seconds are cut short.
+
+    Tick duration, lag (how late a tick started) and missed ticks are kept on the loop and in the `stats` hash under
+    `{name}_tick_*`.
+    """
+
+    def __init__(self, name, func, interval, max_backoff=300, timeout=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.ticks = 0
+        self.missed = 0
+        self.failures = 0
+        self.last_duration = 0
+        self.last_lag = 0
+        self.next_tick = None
+
+    def backoff(self) -> float:
+        delay = min(self.interval * 2 ** (self.failures - 1), self.max_backoff)
+        return delay / 2 + random.random() * delay / 2
+
+    def run(self):
+        self.next_tick = time.monotonic() + self.interval
+        while True:
+            delay = self.next_tick - time.monotonic()
+            if delay > 0:
+                gevent.sleep(delay)
+
+            started = time.monotonic()
+            self.last_lag = started - self.next_tick
+            ok = self._tick()
+            finished = time.monotonic()
+            self.last_duration = finished - started
+            self.ticks += 1
+
+            if ok:
+                self.failures = 0
+                self.next_tick += self.interval
+                if self.next_tick < finished:
+                    missed = math.ceil((finished - self.next_tick) / self.interval)
+                    log.warning("%s tick took %.2fs, skipping %s missed tick(s)", self.name, self.last_duration,
+                                missed)
+                    self.missed += missed
+                    self.next_tick += missed * self.interval
+                    POLL_TICKS_MISSED.inc(missed, loop=self.name)
+            else:
+                self.failures += 1
+                POLL_TICK_FAILURES.inc(loop=self.name)
+                backoff = self.backoff()
+                log.warning("%s tick failed (%s in a row), next tick in %.1fs", self.name, self.failures, backoff)
+                self.next_tick = finished + backoff
+
+            self._record()
+
+    def _tick(self) -> bool:
+        try:
+            with gevent.Timeout(self.timeout):
+                return self.func() is not False
+        except gevent.Timeout:
+            log.error("%s tick timed out after %ss", self.name, self.timeout)
+        except Exception:
+            log.exception("%s tick failed", self.name)
+        return False
+
+    def _record(self):
+        POLL_TICK_SECONDS.observe(self.last_duration, loop=self.name)
+        POLL_TICK_LAG_SECONDS.set(self.last_lag, loop=self.name)
+        try:
+            rdb.hset("stats", mapping={
+                f"{self.name}_tick_duration": round(self.last_duration, 3),
+                f"{self.name}_tick_lag": round(self.last_lag, 3),
+                f"{self.name}_ticks_missed": self.missed,
+                f"{self.name}_tick_failures": self.failures
+            })
+        except Exception:
+            log.exception("Unable to record %s tick stats", self.name)
+
+    def metrics(self) -> dict:
+        return {
+            'ticks': self.ticks,
+            'missed': self.missed,
+            'failures': self.failures,
+            'duration': self.last_duration,
+            'lag': self.last_lag
+        }
@@ -0,0 +1,168 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from gevent.pywsgi import WSGIServer
+
+log = logging.getLogger(__name__)
+
+REGISTRY = []
+
+# Seconds, covers a redis GET up to a Helix request stuck behind the rate limiter
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(labels, extra=None) -> str:
+    pairs = list(labels) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metric(object):
+    """
+    A metric in the Prometheus text format. Values are kept per set of labels, passed as keyword arguments.
+    Nothing here yields to gevent, so updates don't need a lock.
+    """
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        REGISTRY.append(self)
+
+    @staticmethod
+    def _key(labels) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, labels, value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{format_labels(labels)} {value}" for name, labels, value in self.samples()]
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Either set directly, or read from `func` on every scrape. `func` returns a dict of label dicts to values,
+    `{(): value}` for an unlabelled gauge.
+    """
+    type = "gauge"
+
+    def __init__(self, name, documentation, func=None):
+        super(Gauge, self).__init__(name, documentation)
+        self.func = func
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.func is None:
+            yield from super(Gauge, self).samples()
+            return
+
+        for labels, value in self.func().items():
+            yield self.name, self._key(dict(labels)), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        try:
+            lines += metric.render()
+        except Exception:
+            log.exception("Unable to render metric %s", metric.name)
+    return "\n".join(lines) + "\n"
+
+
+def metrics_app(environ, start_response):
+    if environ.get('PATH_INFO') != "/metrics":
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not Found\n"]
+
+    body = render().encode('utf-8')
+    start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+                              ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def serve_metrics(host="127.0.0.1", port=9108):
+    log.info("Serving metrics on http://%s:%s/metrics", host, port)
+    WSGIServer((host, port), metrics_app, log=None).serve_forever()
+
+
+POLL_TICK_SECONDS = Histogram("taverncrier_poll_tick_seconds", "How long each poll tick took.")
+POLL_TICK_LAG_SECONDS = Gauge("taverncrier_poll_tick_lag_seconds", "How late the last poll tick started.")
+POLL_TICKS_MISSED = Counter("taverncrier_poll_ticks_missed_total", "Poll ticks skipped because the last one overran.")
+POLL_TICK_FAILURES = Counter("taverncrier_poll_tick_failures_total", "Poll ticks that failed or timed out.")
+STREAMERS_POLLED = Counter("taverncrier_streamers_polled_total", "Streamers looked up on Helix by poll ticks.")
+LIVE_STREAMS = Gauge("taverncrier_live_streams", "Tracked streams the last poll tick found live.")
+
+HELIX_REQUEST_SECONDS = Histogram("taverncrier_helix_request_seconds", "Helix request latency by route.")
+HELIX_REQUESTS = Counter("taverncrier_helix_requests_total", "Helix requests by route and status code.")
+
+DISCORD_REQUEST_SECONDS = Histogram("taverncrier_discord_request_seconds", "Discord API latency by route.")
+DISCORD_MESSAGES = Counter("taverncrier_discord_messages_total", "Notification messages created, edited and deleted.")
+
+REDIS_COMMAND_SECONDS = Histogram("taverncrier_redis_command_seconds", "Redis command and pipeline latency.")
+POSTGRES_QUERY_SECONDS = Histogram("taverncrier_postgres_query_seconds", "Postgres query latency by statement.")
+
+CACHE_REQUESTS = Counter("taverncrier_cache_requests_total", "Cache lookups by cache and result.")
+
+ANNOUNCEMENT_LATENCY_SECONDS = Histogram("taverncrier_announcement_latency_seconds",
+                                        "Seconds from a stream starting to it being detected and announced.",
+                                        buckets=(1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300, 600))
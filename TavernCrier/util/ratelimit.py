@@ -0,0 +1,91 @@
+import time
+
+import gevent
+
+
+class RequestPriority(object):
+    POLL = 0
+    USER = 1
+
+
+class HelixRateLimiter(object):
+    """
+    Token bucket for the Helix API, kept in sync with the Ratelimit-* headers Twitch sends back.
+    Poll requests may use the whole bucket, user triggered lookups leave `reserve` points for the poller
+    and are shed if they would have to wait longer than `max_wait`.
+    """
+
+    def __init__(self, limit=800, reserve=80, max_wait=10):
+        self.limit = limit
+        self.remaining = limit
+        self.reset_at = time.time() + 60
+        self.reserve = reserve
+        self.max_wait = max_wait
+
+        self.waiting = {RequestPriority.POLL: 0, RequestPriority.USER: 0}
+        self.wait_time = {RequestPriority.POLL: 0.0, RequestPriority.USER: 0.0}
+        self.acquired = {RequestPriority.POLL: 0, RequestPriority.USER: 0}
+        self.shed = 0
+
+    def _refill(self):
+        now = time.time()
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + 60
+
+    def _allowed(self, priority):
+        if priority == RequestPriority.POLL:
+            return self.remaining > 0
+        return self.remaining > self.reserve and not self.waiting[RequestPriority.POLL]
+
+    def acquire(self, priority=RequestPriority.USER) -> bool:
+        """
+        Takes a point from the bucket, waiting for the bucket to reset if needed. Returns False if the request was shed.
+        """
+        started = time.time()
+        self.waiting[priority] += 1
+        try:
+            while True:
+                self._refill()
+                if self._allowed(priority):
+                    self.remaining -= 1
+                    self.acquired[priority] += 1
+                    return True
+
+                wait = max(self.reset_at - time.time(), 0.05)
+                if priority != RequestPriority.POLL and (time.time() - started) + wait > self.max_wait:
+                    self.shed += 1
+                    return False
+
+                gevent.sleep(min(wait, 1))
+        finally:
+            self.waiting[priority] -= 1
+            self.wait_time[priority] += time.time() - started
+
+    def update(self, headers, status_code=None):
+        try:
+            if 'Ratelimit-Limit' in headers:
+                self.limit = int(headers['Ratelimit-Limit'])
+            if 'Ratelimit-Remaining' in headers:
+                self.remaining = int(headers['Ratelimit-Remaining'])
+            if 'Ratelimit-Reset' in headers:
+                self.reset_at = float(headers['Ratelimit-Reset'])
+        except ValueError:
+            pass
+
+        if status_code == 429:
+            self.remaining = 0
+
+    def metrics(self) -> dict:
+        return {
+            'limit': self.limit,
+            'remaining': self.remaining,
+            'reset_in': max(self.reset_at - time.time(), 0),
+            'queue_depth_poll': self.waiting[RequestPriority.POLL],
+            'queue_depth_user': self.waiting[RequestPriority.USER],
+            'wait_seconds_poll': self.wait_time[RequestPriority.POLL],
+            'wait_seconds_user': self.wait_time[RequestPriority.USER],
+            'requests_poll': self.acquired[RequestPriority.POLL],
+            'requests_user': self.acquired[RequestPriority.USER],
+            'shed': self.shed,
+        }
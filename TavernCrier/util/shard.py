@@ -0,0 +1,187 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import time
+import uuid
+
+import gevent
+from redis.exceptions import WatchError
+
+from TavernCrier.redis import rdb
+
+log = logging.getLogger(__name__)
+
+# Takes or renews a partition lease for ARGV[1]. Returns the fencing token it's held under, 0 if someone else holds
+# it. Every new holder bumps the token, renewals keep it.
+ACQUIRE_SCRIPT = rdb.register_script("""
+local owner = redis.call('GET', KEYS[1])
+if owner == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return tonumber(redis.call('GET', KEYS[2]))
+elseif not owner then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return redis.call('INCR', KEYS[2])
+end
+return 0
+""")
+
+# Drops a lease, only if ARGV[1] still holds it.
+RELEASE_SCRIPT = rdb.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+def stable_hash(value) -> int:
+    # Python's hash() is salted per process, every worker has to agree on this one.
+    return int(hashlib.md5(str(value).encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of workers, each placed `vnodes` times so partitions spread evenly. Adding or removing a
+    worker only moves the partitions that land next to it.
+    """
+
+    def __init__(self, members, vnodes=32):
+        self.members = tuple(sorted(members))
+        self._ring = sorted((stable_hash(f"{member}#{i}"), member) for member in self.members for i in range(vnodes))
+        self._hashes = [h for h, _ in self._ring]
+
+    def owner(self, key):
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._hashes, stable_hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+class LostOwnership(Exception):
+    """
+    Someone else took over the streamers a transaction was written for, nothing in it was committed.
+    """
+
+
+class NotOwner(LostOwnership):
+    pass
+
+
+class ShardCoordinator(object):
+    """
+    Splits streamers between every bot process polling the same redis.
+
+    Streamers are hashed into a fixed number of partitions, and partitions are spread over the live workers with a
+    consistent hash ring. Workers heartbeat into the `poll_workers` sorted set every `heartbeat_interval` seconds, ones
+    that miss `lease_ttl` seconds of heartbeats are dropped and their partitions move to whoever is next on the ring.
+
+    A worker only handles a partition while it holds that partition's lease in redis. Leases are released as soon as
+    the ring says a partition belongs elsewhere, and a worker that can't renew its leases stops handling them before
+    they can expire. Ownership is only checked when a tick starts though, and the heartbeat can hand partitions over
+    while it runs, so writes go through `fence()`: every new holder of a partition bumps its fencing token, and a
+    transaction only commits if none of the partitions it touches changed hands since it was fenced.
+    """
+    WORKERS_KEY = "poll_workers"
+
+    def __init__(self, partitions=64, heartbeat_interval=5, lease_ttl=15, vnodes=32):
+        self.partitions = partitions
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_ttl = lease_ttl
+        self.vnodes = vnodes
+
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.ring = HashRing([])
+        self.owned = frozenset()
+        self.tokens = {}
+        self.renewed_at = 0
+
+    @staticmethod
+    def lease_key(partition):
+        return f"poll_partition:{partition}"
+
+    @staticmethod
+    def token_key(partition):
+        return f"poll_partition:{partition}:token"
+
+    def partition(self, user_id) -> int:
+        return stable_hash(user_id) % self.partitions
+
+    def owns(self, user_id) -> bool:
+        if time.monotonic() - self.renewed_at > self.lease_ttl - self.heartbeat_interval:
+            return False
+        return self.partition(user_id) in self.owned
+
+    def heartbeat(self):
+        now = time.time()
+        pipe = rdb.pipeline()
+        pipe.zadd(self.WORKERS_KEY, {self.worker_id: now})
+        pipe.zremrangebyscore(self.WORKERS_KEY, "-inf", now - self.lease_ttl)
+        pipe.zrange(self.WORKERS_KEY, 0, -1)
+        members = pipe.execute()[-1]
+
+        if tuple(sorted(members)) != self.ring.members:
+            log.info("Poll workers changed, now %s: %s", len(members), ", ".join(members))
+            self.ring = HashRing(members, self.vnodes)
+
+        wanted = [p for p in range(self.partitions) if self.ring.owner(p) == self.worker_id]
+
+        started = time.monotonic()
+        pipe = rdb.pipeline()
+        for partition in self.owned.difference(wanted):
+            RELEASE_SCRIPT(keys=[self.lease_key(partition)], args=[self.worker_id], client=pipe)
+        for partition in wanted:
+            ACQUIRE_SCRIPT(keys=[self.lease_key(partition), self.token_key(partition)],
+                           args=[self.worker_id, int(self.lease_ttl * 1000)], client=pipe)
+        results = pipe.execute()[-len(wanted):] if wanted else []
+
+        tokens = {p: token for p, token in zip(wanted, results) if token}
+        if tokens.keys() != self.owned:
+            log.info("Now handling %s of %s partitions", len(tokens), self.partitions)
+        self.tokens = tokens
+        self.owned = frozenset(tokens)
+        self.renewed_at = started
+
+    def fence(self, pipe, user_ids):
+        """
+        Starts a transaction on `pipe` that only commits while we still hold the partitions of every streamer in
+        `user_ids` under the same fencing tokens, raises NotOwner if we already don't.
+        """
+        partitions = sorted({self.partition(user_id) for user_id in user_ids})
+        if not partitions:
+            return
+
+        keys = [self.token_key(partition) for partition in partitions]
+        pipe.watch(*keys)
+        held = [self.tokens.get(partition) for partition in partitions]
+        current = pipe.mget(keys)
+        if any(not self.owns(user_id) for user_id in user_ids) or \
+                [str(token) for token in held] != current:
+            pipe.reset()
+            raise NotOwner(f"No longer handling all {len(partitions)} partitions")
+        pipe.multi()
+
+    @staticmethod
+    def execute(pipe):
+        try:
+            return pipe.execute()
+        except WatchError:
+            raise NotOwner("Partitions changed hands before the transaction committed")
+
+    def run(self):
+        while True:
+            try:
+                self.heartbeat()
+            except Exception:
+                log.exception("Shard heartbeat failed")
+            gevent.sleep(self.heartbeat_interval)
+
+    def leave(self):
+        pipe = rdb.pipeline()
+        pipe.zrem(self.WORKERS_KEY, self.worker_id)
+        for partition in self.owned:
+            RELEASE_SCRIPT(keys=[self.lease_key(partition)], args=[self.worker_id], client=pipe)
+        pipe.execute()
+        self.owned = frozenset()
+        self.tokens = {}
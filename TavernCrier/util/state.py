@@ -0,0 +1,187 @@
+import json
+
+from redis.commands.json.path import Path
+
+from TavernCrier.redis import rdb
+
+
+def live_update_key(user_id):
+    return f"live_update:{user_id}"
+
+
+def load_live_updates(user_ids) -> dict:
+    """
+    Returns the live update state for every streamer given, keyed by streamer then config id, in one round trip.
+
+    There's an entry for every notification queued or sent for the streamer's current stream. `pending` ones are
+    still waiting on the outbound queue and have no `mid` yet, ones with `live_update` off are never edited.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+
+    pipe = rdb.pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.hgetall(live_update_key(user_id))
+
+    return {
+        user_id: {cfg_id: json.loads(raw) for cfg_id, raw in entries.items()}
+        for user_id, entries in zip(user_ids, pipe.execute())
+    }
+
+
+def set_live_update(pipe, user_id, cfg_id, data):
+    pipe.hset(live_update_key(user_id), str(cfg_id), json.dumps(data))
+
+
+# Writes a pending announcement's entry, as long as its job was the one queued under the idempotency key.
+SET_PENDING_SCRIPT = rdb.register_script("""
+if redis.call('GET', KEYS[2]) == ARGV[3] then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+""")
+
+
+def set_pending_live_update(pipe, user_id, cfg_id, data, idempotency_key):
+    """
+    Like `set_live_update` for the entry of an announce job that was just pushed on `pipe`. If the push was turned
+    away by `idempotency_key`, nothing is written, otherwise the entry would wait on a job that never runs.
+    """
+    SET_PENDING_SCRIPT(keys=[live_update_key(user_id), idempotency_key],
+                       args=[str(cfg_id), json.dumps(data), data['job']], client=pipe)
+
+
+def remove_live_update(pipe, user_id, cfg_id=None):
+    if cfg_id is None:
+        pipe.unlink(live_update_key(user_id))
+    else:
+        pipe.hdel(live_update_key(user_id), str(cfg_id))
+
+
+def migrate_live_update_keys() -> int:
+    """
+    Folds the old per config `live_update:{user}:{config}` JSON keys into the per streamer hashes.
+    Uses SCAN so it doesn't block redis, and is a no-op once nothing is left to migrate.
+    """
+    migrated = 0
+    for key in rdb.scan_iter(match="live_update:*:*", count=500):
+        _, user_id, cfg_id = key.split(":", 2)
+        data = rdb.json().get(key, Path.root_path())
+        pipe = rdb.pipeline()
+        if data:
+            set_live_update(pipe, user_id, cfg_id, data)
+        pipe.unlink(key)
+        pipe.execute()
+        migrated += 1
+
+    return migrated
+
+
+def stream_history_key(user_id):
+    return f"stream_history:{user_id}"
+
+
+def record_stream_history(pipe, user_id, event, timestamp, size=100):
+    """
+    Keeps the last `size` go live (`online`) and go offline (`offline`) events for a streamer, newest first.
+    """
+    pipe.lpush(stream_history_key(user_id), f"{event}:{timestamp}")
+    pipe.ltrim(stream_history_key(user_id), 0, size - 1)
+
+
+class StreamOnline(object):
+    """
+    Emitted on the client's event emitter once a tracked streamer's go live has been written to `currently_live`.
+    Their announcements are queued at this point, not necessarily sent.
+    """
+    def __init__(self, user_id, stream):
+        self.user_id = user_id
+        self.stream = stream
+
+
+class StreamOffline(object):
+    """
+    Emitted on the client's event emitter once a tracked streamer has been removed from `currently_live`.
+    """
+    def __init__(self, user_id, notifications):
+        self.user_id = user_id
+        self.notifications = notifications
+
+
+def live_streamer_ids() -> set:
+    return set(rdb.hkeys("currently_live"))
+
+
+def load_currently_live() -> dict:
+    return {user_id: json.loads(raw) for user_id, raw in rdb.hgetall("currently_live").items()}
+
+
+def diff_currently_live(previous, current) -> (list, list, list):
+    """
+    Returns the streamers that went live, went offline, and the ones that stayed live but whose stream changed.
+    """
+    went_live = [user_id for user_id in current if user_id not in previous]
+    went_offline = [user_id for user_id in previous if user_id not in current]
+    changed = [user_id for user_id in current if user_id in previous and previous[user_id] != current[user_id]]
+    return went_live, went_offline, changed
+
+
+def write_currently_live(pipe, current, went_live, went_offline, changed):
+    for user_id in went_live + changed:
+        pipe.hset("currently_live", user_id, json.dumps(current[user_id]))
+    if went_offline:
+        pipe.hdel("currently_live", *went_offline)
+
+
+def migrate_currently_live() -> bool:
+    """
+    Converts the old `currently_live`, either the single JSON document or the per streamer hash of notification
+    lists, into a per streamer hash of streams. Notifications move into the streamer's live update hash, the ones
+    that weren't live updating under a `legacy:{mid}` field, so their end actions still run.
+    """
+    if rdb.type("currently_live") == "ReJSON-RL":
+        data = rdb.json().get("currently_live", Path.root_path()) or {}
+    else:
+        data = {user_id: json.loads(raw) for user_id, raw in rdb.hgetall("currently_live").items()}
+        data = {user_id: notifications for user_id, notifications in data.items() if isinstance(notifications, list)}
+        if not data:
+            return False
+
+    entries = load_live_updates(data.keys())
+    pipe = rdb.pipeline()
+    if rdb.type("currently_live") == "ReJSON-RL":
+        pipe.unlink("currently_live")
+    for user_id, notifications in data.items():
+        by_mid = {str(entry.get('mid')): cfg_id for cfg_id, entry in entries[user_id].items()}
+        for notif in notifications:
+            cfg_id = by_mid.get(str(notif['mid']))
+            if cfg_id:
+                set_live_update(pipe, user_id, cfg_id, dict(entries[user_id][cfg_id], **notif, live_update=True))
+            else:
+                set_live_update(pipe, user_id, f"legacy:{notif['mid']}", dict(notif, live_update=False))
+
+        stream = {'username': notifications[0]['username'] if notifications else None,
+                  'stream_id': notifications[0].get('stream_id') if notifications else None}
+        pipe.hset("currently_live", user_id, json.dumps(stream))
+    pipe.execute()
+    return True
+
+
+# Writes a sent announcement's entry, as long as the streamer is still live and the entry still belongs to the job
+# that sent it. Returns 1 if written, 0 if the stream has ended, -1 if the entry was removed or replaced since.
+COMMIT_NOTIFICATION_SCRIPT = rdb.register_script("""
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+local current = redis.call('HGET', KEYS[2], ARGV[2])
+if not current or cjson.decode(current)['job'] ~= ARGV[3] then
+    return -1
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[4])
+return 1
+""")
+
+
+def commit_notification(user_id, cfg_id, job_id, data) -> int:
+    return COMMIT_NOTIFICATION_SCRIPT(keys=["currently_live", live_update_key(user_id)],
+                                      args=[user_id, str(cfg_id), job_id, json.dumps(data)])
@@ -1,22 +1,52 @@
+import copy
+import os
+import time
+
 import yaml
 
 
-def get_component_template(name):
-    with open('./data/components.yaml', 'r', encoding='utf-8') as f:
-        raw = yaml.safe_load(f)
+class TemplateRegistry(object):
+    """
+    Parses a template file once and hands out copies, so callers are free to modify what they get back.
+    The file is reloaded when its mtime changes, checked at most once every `check_interval` seconds.
+    """
 
-    return raw['components'][name]
+    def __init__(self, path, check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self._templates = None
+        self._mtime = None
+        self._checked_at = 0
 
+    def _reload(self):
+        now = time.monotonic()
+        if self._templates is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
 
-def get_embed_template(name):
-    with open('./data/components.yaml', 'r', encoding='utf-8') as f:
-        raw = yaml.safe_load(f)
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return
 
-    return raw['embeds'][name]
+        with open(self.path, 'r', encoding='utf-8') as f:
+            self._templates = yaml.safe_load(f)
+        self._mtime = mtime
 
+    def get(self, section, name):
+        self._reload()
+        return copy.deepcopy(self._templates[section][name])
 
-def get_string_template(name):
-    with open('./data/components.yaml', 'r', encoding='utf-8') as f:
-        raw = yaml.safe_load(f)
 
-    return raw['strings'][name]
+components = TemplateRegistry('./data/components.yaml')
+
+
+def get_component_template(name):
+    return components.get('components', name)
+
+
+def get_embed_template(name):
+    return components.get('embeds', name)
+
+
+def get_string_template(name):
+    return components.get('strings', name)
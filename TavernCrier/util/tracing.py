@@ -0,0 +1,66 @@
+from TavernCrier.redis import rdb
+
+TRACES_KEY = "announcement_traces"
+
+
+class AnnouncementTrace(object):
+    """
+    Timings of a single go live announcement, as unix timestamps: when Twitch says the stream started, when a poll
+    tick or EventSub notification picked it up, when its notification was rendered, and when Discord returned the
+    created message.
+    """
+    __slots__ = ('source', 'started_at', 'detected_at', 'rendered_at', 'sent_at')
+
+    def __init__(self, source, started_at, detected_at, rendered_at, sent_at):
+        self.source = source
+        self.started_at = started_at
+        self.detected_at = detected_at
+        self.rendered_at = rendered_at
+        self.sent_at = sent_at
+
+    @property
+    def detection(self) -> float:
+        return self.detected_at - self.started_at
+
+    @property
+    def render(self) -> float:
+        return self.rendered_at - self.detected_at
+
+    @property
+    def send(self) -> float:
+        return self.sent_at - self.rendered_at
+
+    @property
+    def delivery(self) -> float:
+        return self.sent_at - self.started_at
+
+    def dumps(self) -> str:
+        # Kept small, the ring buffer holds a lot of these.
+        return f"{self.source}|{self.started_at:.0f}|{self.detection:.3f}|{self.render:.3f}|{self.send:.3f}"
+
+    @classmethod
+    def loads(cls, raw):
+        source, started_at, detection, render, send = raw.split("|")
+        started_at = float(started_at)
+        detected_at = started_at + float(detection)
+        rendered_at = detected_at + float(render)
+        return cls(source, started_at, detected_at, rendered_at, rendered_at + float(send))
+
+
+def record_trace(pipe, trace, size=1000):
+    pipe.lpush(TRACES_KEY, trace.dumps())
+    pipe.ltrim(TRACES_KEY, 0, size - 1)
+
+
+def load_traces(limit=1000) -> list[AnnouncementTrace]:
+    return [AnnouncementTrace.loads(raw) for raw in rdb.lrange(TRACES_KEY, 0, limit - 1)]
+
+
+def percentiles(values, points=(50, 95, 99)) -> dict:
+    """
+    Nearest rank percentiles, None for each point when there's nothing to rank.
+    """
+    values = sorted(values)
+    if not values:
+        return {point: None for point in points}
+    return {point: values[min(len(values) - 1, max(0, -(-point * len(values) // 100) - 1))] for point in points}
@@ -1,56 +1,298 @@
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
 import requests
+from gevent.lock import Semaphore
+from gevent.pool import Pool
+from redis.exceptions import LockError
+from requests.adapters import HTTPAdapter
 
 from TavernCrier import config
 from TavernCrier.redis import rdb
+from TavernCrier.util.metrics import HELIX_REQUEST_SECONDS, HELIX_REQUESTS, Gauge
+from TavernCrier.util.ratelimit import HelixRateLimiter, RequestPriority
+
+HELIX_STREAMS_URL = "https://api.twitch.tv/helix/streams"
+
+# Helix caps both the number of user_id params and the page size at 100.
+HELIX_MAX_IDS = 100
+
+TWITCH_API_CONFIG = config.get('twitch_api') or {}
+
+
+class TwitchClient(object):
+    """
+    Long-lived Twitch API client. Keeps a pooled keep-alive session to Twitch and the access token in process
+    until it expires, only going to redis when it doesn't know the token.
+
+    Token refreshes are single-flight, one greenlet refreshes while the rest wait for its result, and a redis lock
+    makes sure only one bot process refreshes at a time.
+    """
+    TOKEN_URL = "https://id.twitch.tv/oauth2/token"
+    VALIDATE_URL = "https://id.twitch.tv/oauth2/validate"
+
+    def __init__(self, client_id, client_secret, refresh_token, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 refresh_margin=300, max_auth_retries=1, ratelimit=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_token = refresh_token
+        self.timeout = (connect_timeout, read_timeout)
+        self.refresh_margin = refresh_margin
+        self.max_auth_retries = max_auth_retries
+        self.ratelimit = ratelimit or HelixRateLimiter()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Client-Id": client_id})
+
+        self._access_token = None
+        self._access_token_expires = 0
+
+        self._refresh_lock = Semaphore()
+        self._refresh_generation = 0
+        self._refresh_retry_at = 0
+
+    def _cache_token(self, token, expires_in):
+        self._access_token = token
+        self._access_token_expires = time.time() + expires_in
 
+    def _load_access_token(self):
+        pipe = rdb.pipeline(transaction=False)
+        pipe.get("twitch_access_token")
+        pipe.ttl("twitch_access_token")
+        token, ttl = pipe.execute()
 
-def make_twitch_request(route, method: str, params: dict | str = None, body: dict = None) -> (int, dict | None):
-    if not rdb.exists("twitch_access_token"):
-        success, expire = refresh_access_token()
-        if not success:
-            return 401, None
+        if not token:
+            return None, 0
 
-    url = route
+        # A key without an expiry reports -1, give it a short life so we check redis again soon.
+        ttl = ttl if ttl > 0 else 60
+        self._cache_token(token, ttl)
+        return token, ttl
 
-    request_method = getattr(requests, method.lower())
+    def invalidate_access_token(self):
+        self._access_token = None
+        self._access_token_expires = 0
 
-    response = request_method(url, params=params, json=body, headers={
-        "Client-Id": config.twitch_login['client_id'],
-        "Authorization": f"Bearer {rdb.get('twitch_access_token')}"
-    })
+    def get_access_token(self):
+        token, ttl = self._access_token, self._access_token_expires - time.time()
+        if not token or ttl <= 0:
+            token, ttl = self._load_access_token()
 
-    if response.status_code == 401:
-        success, expire = refresh_access_token()
+        if token and (ttl > self.refresh_margin or time.time() < self._refresh_retry_at):
+            return token
+
+        # Missing or close to expiring, refresh ahead of time. If that fails keep using the old token until it's gone.
+        success, expire = self.refresh_access_token(stale_token=token)
         if success:
-            return make_twitch_request(route, method, params=params, body=body)
-        else:
-            return 401, response.json()
+            return self._access_token
+
+        return token if ttl > 0 else None
+
+    def request(self, route, method: str, params: dict | list | str = None, body: dict = None,
+                priority=RequestPriority.USER) -> (int, dict | None):
+        response = None
+        auth_retries = 0
+        ratelimited = False
+        while True:
+            if not self.ratelimit.acquire(priority):
+                return 429, None
+
+            token = self.get_access_token()
+            if not token:
+                return 401, None
+
+            path = urlparse(route).path
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method.upper(), route, params=params, json=body, timeout=self.timeout,
+                                                headers={"Authorization": f"Bearer {token}"})
+            except requests.exceptions.RequestException:
+                HELIX_REQUESTS.inc(route=path, status="error")
+                raise
+            finally:
+                HELIX_REQUEST_SECONDS.observe(time.perf_counter() - started, route=path)
+            HELIX_REQUESTS.inc(route=path, status=response.status_code)
+            self.ratelimit.update(response.headers, response.status_code)
+
+            # The bucket is now empty, so the next acquire waits for the reset instead of retrying blindly.
+            if response.status_code == 429 and priority == RequestPriority.POLL and not ratelimited:
+                ratelimited = True
+                continue
+
+            if response.status_code == 401 and auth_retries < self.max_auth_retries:
+                auth_retries += 1
+                self.invalidate_access_token()
+                success, expire = self.refresh_access_token(stale_token=token)
+                if success:
+                    continue
+
+            break
+
+        return response.status_code, response.json() if len(response.content) != 0 else None
+
+    def refresh_access_token(self, refresh_token=None, stale_token=None):
+        """
+        Refreshes the access token, unless someone else already did while we were waiting our turn.
+        `stale_token` is the token the caller saw fail or expire, anything else in redis is taken as already refreshed.
+        """
+        generation = self._refresh_generation
+        with self._refresh_lock:
+            if generation != self._refresh_generation and self._access_token:
+                return True, int(self._access_token_expires - time.time())
+
+            lock = rdb.lock("twitch_access_token:refresh", timeout=sum(self.timeout) * 2,
+                            blocking_timeout=sum(self.timeout) * 2)
+            if not lock.acquire():
+                # Another process is taking its sweet time, take whatever it managed to store.
+                token, ttl = self._load_access_token()
+                if token and token != stale_token:
+                    return True, ttl
+                return False, None
 
-    return response.status_code, response.json() if len(response.content) != 0 else None
+            try:
+                if not refresh_token:
+                    token, ttl = self._load_access_token()
+                    if token and token != stale_token and ttl > self.refresh_margin:
+                        self._refresh_generation += 1
+                        return True, ttl
+
+                return self._refresh_access_token(refresh_token)
+            finally:
+                try:
+                    lock.release()
+                except LockError:
+                    pass
+
+    def _refresh_access_token(self, refresh_token=None):
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+
+        response = self.session.post(self.TOKEN_URL, headers=headers, timeout=self.timeout,
+                                     params={'client_id': self.client_id,
+                                             'client_secret': self.client_secret,
+                                             'grant_type': "refresh_token",
+                                             'refresh_token': refresh_token or self.refresh_token})
+
+        if response.status_code == 200:
+            rjson = response.json()
+
+            rdb.set("twitch_access_token", rjson['access_token'], ex=rjson['expires_in'])
+            self._cache_token(rjson['access_token'], rjson['expires_in'])
+            self._refresh_generation += 1
+
+            return True, rjson['expires_in']
+
+        # Don't hammer the token endpoint on every request while the current token is still good.
+        self._refresh_retry_at = time.time() + 30
+        return False, None
+
+    def validate_access_token(self) -> int | None:
+        """
+        Validates the current access token with Twitch, returns the status code or None if there is no token.
+        """
+        token = self.get_access_token()
+        if not token:
+            return None
+
+        response = self.session.get(self.VALIDATE_URL, timeout=self.timeout, headers={'Authorization': f"OAuth {token}"})
+        if response.status_code == 401:
+            # Known bad, don't let anyone pick it back up from redis.
+            self.invalidate_access_token()
+            rdb.delete("twitch_access_token")
+
+        return response.status_code
+
+
+twitch = TwitchClient(config.twitch_login['client_id'], config.twitch_login['client_secret'],
+                      config.twitch_login['refresh_token'],
+                      pool_size=TWITCH_API_CONFIG.get('pool_size', 10),
+                      connect_timeout=TWITCH_API_CONFIG.get('connect_timeout', 3.05),
+                      read_timeout=TWITCH_API_CONFIG.get('read_timeout', 10),
+                      refresh_margin=TWITCH_API_CONFIG.get('refresh_margin', 300),
+                      max_auth_retries=TWITCH_API_CONFIG.get('max_auth_retries', 1),
+                      ratelimit=HelixRateLimiter(limit=TWITCH_API_CONFIG.get('ratelimit', 800),
+                                                 reserve=TWITCH_API_CONFIG.get('ratelimit_poll_reserve', 80),
+                                                 max_wait=TWITCH_API_CONFIG.get('ratelimit_max_wait', 10)))
+
+HELIX_RATELIMIT = Gauge("taverncrier_helix_ratelimit", "Helix rate limiter state.",
+                        lambda: {(('field', name),): value for name, value in twitch.ratelimit.metrics().items()})
+
+
+def make_twitch_request(route, method: str, params: dict | list | str = None, body: dict = None,
+                        priority=RequestPriority.USER) -> (int, dict | None):
+    return twitch.request(route, method, params=params, body=body, priority=priority)
 
 
 def refresh_access_token(refresh_token=None):
-    url = "https://id.twitch.tv/oauth2/token"
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    client_id = config.twitch_login['client_id']
-    client_secret = config.twitch_login['client_secret']
-    grant_type = "refresh_token"
+    return twitch.refresh_access_token(refresh_token)
+
+
+def chunk_ids(ids, size=HELIX_MAX_IDS):
+    ids = list(ids)
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+def get_live_streams(user_ids) -> (int, dict):
+    """
+    Polls helix/streams for every user id given, split into Helix sized batches that are sent concurrently.
+    Returns the worst status code seen and the live streams keyed by user_id. If any batch fails the
+    status code will not be 200, and callers should not treat missing users as offline.
+    """
+    batches = chunk_ids(user_ids)
+    if not batches:
+        return 200, {}
+
+    def fetch(batch):
+        return make_twitch_request(HELIX_STREAMS_URL, "GET",
+                                   params=[('type', 'live'), ('first', HELIX_MAX_IDS)] + [('user_id', uid) for uid in batch],
+                                   priority=RequestPriority.POLL)
+
+    pool = Pool(TWITCH_API_CONFIG.get('poll_concurrency', 4))
+
+    code = 200
+    live_streams = {}
+    for batch_code, rjson in pool.imap_unordered(fetch, batches):
+        if batch_code != 200:
+            code = batch_code
+            continue
+        for stream in (rjson or {}).get('data') or []:
+            live_streams[stream['user_id']] = stream
+
+    return code, live_streams
 
-    if not refresh_token:
-        refresh_token = config.twitch_login['refresh_token']
 
-    response = requests.post(url, headers=headers, params={'client_id': client_id,
-                                                           'client_secret': client_secret,
-                                                           'grant_type': grant_type,
-                                                           'refresh_token': refresh_token})
+def get_latest_vods(user_ids, first=5) -> dict:
+    """
+    Looks up the most recent archived broadcasts for each user. helix/videos only takes a single user_id per request,
+    so the lookups are sent concurrently instead.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
 
-    if response.status_code == 200:
-        rjson = response.json()
+    def fetch(user_id):
+        code, rjson = make_twitch_request("https://api.twitch.tv/helix/videos", "GET",
+                                          params={'user_id': user_id, 'type': "archive", 'first': first},
+                                          priority=RequestPriority.POLL)
+        if code != 200 or not rjson:
+            return user_id, []
+        return user_id, rjson.get('data') or []
 
-        rdb.set("twitch_access_token", rjson['access_token'], ex=rjson['expires_in'])
+    pool = Pool(TWITCH_API_CONFIG.get('poll_concurrency', 4))
+    return dict(pool.imap_unordered(fetch, user_ids))
 
-        return True, rjson['expires_in']
 
-    return False, None
+def parse_twitch_timestamp(timestamp) -> datetime:
+    """
+    Twitch sends RFC3339 timestamps with up to nanosecond precision, more than datetime will take.
+    """
+    main, _, fraction = timestamp.rstrip('Z').partition('.')
+    parsed = datetime.strptime(main, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+    if fraction:
+        parsed = parsed.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+    return parsed
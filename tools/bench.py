@@ -0,0 +1,386 @@
+"""
+Benchmarks for the hot paths of the poll tick, run against the fakes in harness.py. Pick one:
+
+    poetry run python tools/bench.py roundtrips --fakeredis
+    poetry run python tools/bench.py helix --streamers 5000 --concurrency 1 4 8
+    poetry run python tools/bench.py templates
+    poetry run python tools/bench.py render --fakeredis
+    poetry run python tools/bench.py promos --fakeredis
+
+roundtrips  Redis round trips per poll tick against the number of stream configs. Every tick's reads and writes are
+            batched, so the count should stay flat however many configs and live streams there are. Exits 1 if not.
+helix       How long get_live_streams takes per tick against a fake Helix, for each poll_concurrency. Exits 1 if a
+            tick misses a live stream.
+templates   Template lookups through TemplateRegistry against parsing components.yaml on every call, like before it
+            existed. Exits 1 if the registry hands back anything different.
+render      Time spent rendering notifications per tick against the number of configs, sharing renders between
+            configs like the tick does and rendering for every config. Exits 1 if the two render differently.
+promos      MessageCreate events through promotional_messages per second, against how many of them land in promo
+            channels. Exits 1 if a promo was reposted that shouldn't have been.
+"""
+import harness
+
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+import gevent
+import yaml
+from gevent.pool import Pool
+from redis.connection import Connection
+
+from harness import FakeTwitch, FakeDiscord, PromoTraffic, percentile
+
+
+class RoundTrips(object):
+    """
+    Counts requests sent to redis. A pipeline, however long, goes out in one send and is one round trip. The handshake
+    of a new pooled connection isn't counted.
+    """
+
+    def __init__(self):
+        self.count = 0
+        send = Connection.send_packed_command
+
+        def counted(connection, command, check_health=True):
+            if not getattr(connection, 'handshaking', False):
+                self.count += 1
+            return send(connection, command, check_health)
+
+        def handshake(on_connect):
+            def wrapped(connection, *args, **kwargs):
+                handshaking = getattr(connection, 'handshaking', False)
+                connection.handshaking = True
+                try:
+                    return on_connect(connection, *args, **kwargs)
+                finally:
+                    connection.handshaking = handshaking
+            return wrapped
+
+        Connection.send_packed_command = counted
+        # Newer redis-py connects through on_connect_check_health without going through on_connect
+        for name in ('on_connect', 'on_connect_check_health'):
+            if hasattr(Connection, name):
+                setattr(Connection, name, handshake(getattr(Connection, name)))
+
+    def measure(self, func):
+        before = self.count
+        func()
+        return self.count - before
+
+
+def setup_bot(args, twitch_fake, discord_fake):
+    """
+    Loads the bot against the fakes, returns the announcements module, redis and a plugin with outbound handlers.
+    """
+    harness.prepare_workdir(args, check_interval=30, live_update_interval=0, live_update_force_refresh_interval=0,
+                            rouge_key_removal_interval=86400, outbound={'workers': 20})
+    announcements = harness.load_bot()
+
+    from TavernCrier.redis import rdb
+
+    rdb.flushdb()
+    api = harness.redirect(harness.serve(twitch_fake.app), harness.serve(discord_fake.app))
+    plugin = harness.make_plugin(api)
+    outbound = announcements.outbound
+    outbound.handler("announce", plugin.send_announcement)
+    outbound.handler("live_update", plugin.send_live_update)
+    outbound.handler("end_action", plugin.run_end_action)
+    return announcements, rdb, plugin
+
+
+def drain(outbound, timeout=120):
+    workers = [gevent.spawn(outbound.work) for _ in range(outbound.workers)]
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        depth = outbound.metrics()
+        if not depth['ready'] and not depth['delayed'] and not depth['inflight']:
+            break
+        gevent.sleep(0.05)
+    gevent.killall(workers)
+
+
+def roundtrips(args):
+    twitch_fake = FakeTwitch(max(args.sizes), args.live_fraction)
+    discord_fake = FakeDiscord()
+    announcements, rdb, plugin = setup_bot(args, twitch_fake, discord_fake)
+    counter = RoundTrips()
+
+    def measure(size):
+        rdb.flushdb()
+        streamers = twitch_fake.streamers[:size]
+        harness.seed_stream_configs(harness.generate_configs(streamers, size * 2))
+        live = sum(1 for user_id in streamers if user_id in twitch_fake.live)
+
+        # Announce everyone that's live and send it all, so the ticks measured edit rather than announce
+        plugin.stream_grab_schedule()
+        drain(announcements.outbound)
+
+        steady = counter.measure(plugin.stream_grab_schedule)
+        drain(announcements.outbound)
+
+        offline = [user_id for user_id in streamers if user_id not in twitch_fake.live]
+        for user_id in random.sample(sorted(twitch_fake.live.keys() & set(streamers)), args.flips):
+            twitch_fake.go_offline(user_id)
+        for user_id in random.sample(offline, args.flips):
+            twitch_fake.go_live(user_id)
+        churned = counter.measure(plugin.stream_grab_schedule)
+        drain(announcements.outbound)
+
+        return {'streamers': size, 'configs': size * 2, 'live': live, 'steady_tick': steady, 'churn_tick': churned}
+
+    # Scripts are loaded into redis the first time the process runs them, that isn't per tick
+    measure(min(args.sizes))
+    results = [measure(size) for size in args.sizes]
+
+    flat = len({r['steady_tick'] for r in results}) == 1 and len({r['churn_tick'] for r in results}) == 1
+    if args.json:
+        print(json.dumps({'roundtrips': results, 'flat': flat}, indent=2))
+    else:
+        print(f"{'streamers':>10} {'configs':>8} {'live':>6} {'steady tick':>12} {'churn tick':>11}")
+        for r in results:
+            print(f"{r['streamers']:>10} {r['configs']:>8} {r['live']:>6} {r['steady_tick']:>12} "
+                  f"{r['churn_tick']:>11}")
+        print("Round trips per tick are " + ("flat" if flat else "NOT flat") + " in the number of configs")
+    return flat
+
+
+def helix(args):
+    twitch_fake = FakeTwitch(args.streamers, args.live_fraction, latency=args.helix_latency)
+    # At 100 ids a request a few back to back ticks of 5k streamers is more than the 800/min a bot gets. In the bot
+    # ticks are check_interval apart, the limiter isn't what's being measured here so it's given room.
+    harness.prepare_workdir(args, twitch_api={'ratelimit': 100000})
+
+    from TavernCrier.util import twitch
+
+    harness.redirect_twitch(harness.serve(twitch_fake.app))
+    twitch.get_live_streams(twitch_fake.streamers[:1])
+
+    results = []
+    complete = True
+    for concurrency in args.concurrency:
+        twitch.TWITCH_API_CONFIG['poll_concurrency'] = concurrency
+        twitch_fake.requests.clear()
+        seconds = []
+        for _ in range(args.ticks):
+            started = time.perf_counter()
+            code, live_streams = twitch.get_live_streams(twitch_fake.streamers)
+            seconds.append(time.perf_counter() - started)
+            complete &= code == 200 and live_streams.keys() == twitch_fake.live.keys()
+        results.append({'concurrency': concurrency, 'p50': percentile(seconds, 50), 'p95': percentile(seconds, 95),
+                        'max': max(seconds), 'requests_per_tick': twitch_fake.requests[("/helix/streams", 200)] /
+                        args.ticks})
+
+    if args.json:
+        print(json.dumps({'helix': results, 'streamers': args.streamers, 'live': len(twitch_fake.live),
+                          'complete': complete}, indent=2))
+    else:
+        print(f"{args.streamers} streamers ({len(twitch_fake.live)} live), {args.helix_latency * 1000:.0f}ms Helix "
+              f"latency, {args.ticks} ticks each")
+        print(f"{'concurrency':>11} {'requests':>9} {'p50':>8} {'p95':>8} {'max':>8}")
+        for r in results:
+            print(f"{r['concurrency']:>11} {r['requests_per_tick']:>9.0f} {r['p50']:>7.3f}s {r['p95']:>7.3f}s "
+                  f"{r['max']:>7.3f}s")
+        print("Every tick found every live stream" if complete else "Some ticks MISSED live streams")
+    return complete
+
+
+def templates(args):
+    harness.prepare_workdir(args)
+
+    from TavernCrier.util.template import TemplateRegistry
+
+    path = "./data/components.yaml"
+    with open(path, 'r', encoding='utf-8') as f:
+        names = [(section, name) for section, templates in yaml.safe_load(f).items() for name in templates]
+
+    def parse_every_call(section, name):
+        with open(path, 'r', encoding='utf-8') as f:
+            return yaml.safe_load(f)[section][name]
+
+    registry = TemplateRegistry(path)
+    same = all(registry.get(*name) == parse_every_call(*name) for name in names)
+    # Callers modify what they get back, that mustn't leak into the next lookup
+    for name in names:
+        template = registry.get(*name)
+        if isinstance(template, dict):
+            template.clear()
+    same &= all(registry.get(*name) == parse_every_call(*name) for name in names)
+
+    results = []
+    for label, get in (("yaml.safe_load", parse_every_call), ("registry", TemplateRegistry(path).get),
+                       ("registry, stat", TemplateRegistry(path, check_interval=0).get)):
+        started = time.perf_counter()
+        for i in range(args.calls):
+            get(*names[i % len(names)])
+        per_call = (time.perf_counter() - started) / args.calls
+        results.append({'lookup': label, 'us_per_call': per_call * 1e6, 'ms_per_tick': per_call * args.configs * 1e3})
+
+    if args.json:
+        print(json.dumps({'templates': results, 'configs': args.configs, 'same': same}, indent=2))
+    else:
+        print(f"{args.calls} lookups, a tick is {args.configs} (one per config)")
+        print(f"{'lookup':>15} {'per call':>10} {'per tick':>10}")
+        for r in results:
+            print(f"{r['lookup']:>15} {r['us_per_call']:>8.1f}us {r['ms_per_tick']:>8.1f}ms")
+        print("The registry hands out the same templates" if same else "The registry hands out DIFFERENT templates")
+    return same
+
+
+def render(args):
+    twitch_fake = FakeTwitch(args.streamers, 1.0)
+    harness.prepare_workdir(args)
+    harness.load_bot()
+
+    from TavernCrier.redis import rdb
+    from TavernCrier.util.cache import avatars
+
+    rdb.flushdb()
+    harness.redirect_twitch(harness.serve(twitch_fake.app))
+    plugin = harness.make_plugin(None)
+    streams = list(twitch_fake.live.values())
+    # Fetched before the tick renders anything, see process_streams
+    avatars.prefetch(twitch_fake.live.keys())
+
+    def tick(configs, shared):
+        renders = {}
+        hashes = []
+        for stream in streams:
+            for config in configs.get(stream['user_id'], []):
+                enabled_components = [c for c, value in config['config'].items() if value == True]
+                hashes.append(plugin.render_notification(stream, enabled_components, renders if shared else {})[2])
+        return hashes, len(renders)
+
+    results = []
+    same = True
+    for size in args.sizes:
+        configs = harness.generate_configs(twitch_fake.streamers, size)
+        # Not every guild shows the same things
+        for config in (config for cfgs in configs.values() for config in cfgs):
+            for component in random.sample(['tags', 'viewers', 'preview_image', 'button'], random.randint(0, 2)):
+                config['config'][component] = False
+
+        result = {'streamers': args.streamers, 'configs': size}
+        for label, shared in (("shared", True), ("every_config", False)):
+            seconds = []
+            for _ in range(args.ticks):
+                started = time.perf_counter()
+                hashes, renders = tick(configs, shared)
+                seconds.append(time.perf_counter() - started)
+            result[label] = percentile(seconds, 50) * 1000
+            result[label + "_hashes"] = hashes
+            if shared:
+                result['renders'] = renders
+        same &= result.pop("shared_hashes") == result.pop("every_config_hashes")
+        results.append(result)
+
+    if args.json:
+        print(json.dumps({'render': results, 'same': same}, indent=2))
+    else:
+        print(f"Median of {args.ticks} ticks, every streamer live")
+        print(f"{'streamers':>10} {'configs':>8} {'renders':>8} {'shared':>10} {'every config':>13}")
+        for r in results:
+            print(f"{r['streamers']:>10} {r['configs']:>8} {r['renders']:>8} {r['shared']:>8.1f}ms "
+                  f"{r['every_config']:>11.1f}ms")
+        print("Shared renders match rendering every config" if same else "Shared renders DIFFER from rendering "
+                                                                           "every config")
+    return same
+
+
+def promos(args):
+    twitch_fake = FakeTwitch(args.streamers, args.live_fraction)
+    discord_fake = FakeDiscord(latency=args.discord_latency)
+    announcements, rdb, plugin = setup_bot(args, twitch_fake, discord_fake)
+    harness.seed_stream_configs(harness.generate_configs(twitch_fake.streamers, args.streamers))
+    promo_channels = harness.seed_guild_configs(args.guilds, args.promo_guilds)
+
+    # A tick fills the live stream cache the handler looks streams up in
+    plugin.stream_grab_schedule()
+
+    promo_traffic = PromoTraffic(twitch_fake, args.guilds, promo_channels)
+    results = []
+    for share in args.promo_shares:
+        promo_traffic.promo_share = share
+        events = [promo_traffic.event(plugin.client.api) for _ in range(args.messages)]
+        reposts = sum(discord_fake.creates.values())
+
+        started = time.perf_counter()
+        pool = Pool(args.concurrency)
+        for event in events:
+            pool.spawn(plugin.promotional_messages, event)
+        pool.join()
+        seconds = time.perf_counter() - started
+
+        results.append({'promo_share': share, 'messages_per_second': args.messages / seconds,
+                        'reposts': sum(discord_fake.creates.values()) - reposts})
+
+    wrong = promo_traffic.check(discord_fake)['promo_wrong_reposts']
+    if args.json:
+        print(json.dumps({'promos': results, 'messages': args.messages, 'wrong_reposts': wrong}, indent=2))
+    else:
+        print(f"{args.messages} MessageCreate events per run, {args.guilds} guilds ({len(promo_channels)} with "
+              f"promotions), {args.discord_latency * 1000:.0f}ms Discord latency")
+        print(f"{'in promo channels':>17} {'messages/s':>11} {'reposts':>8}")
+        for r in results:
+            print(f"{r['promo_share']:>17.0%} {r['messages_per_second']:>11.0f} {r['reposts']:>8}")
+        print(f"{wrong} reposts that shouldn't have been")
+    return not wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    modes = parser.add_subparsers(dest="mode", required=True)
+
+    mode = modes.add_parser("roundtrips", help="Redis round trips per poll tick")
+    mode.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000], help="Streamers, 2 configs each")
+    mode.add_argument("--live-fraction", type=float, default=0.1)
+    mode.add_argument("--flips", type=int, default=5,
+                      help="Streamers going offline, and going live, before the churn tick")
+    harness.add_arguments(mode)
+
+    mode = modes.add_parser("helix", help="get_live_streams time per tick")
+    mode.add_argument("--streamers", type=int, default=5000)
+    mode.add_argument("--live-fraction", type=float, default=0.1)
+    mode.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8], help="poll_concurrency values")
+    mode.add_argument("--ticks", type=int, default=5)
+    mode.add_argument("--helix-latency", type=float, default=0.1, help="Seconds")
+    harness.add_arguments(mode)
+
+    mode = modes.add_parser("templates", help="Template lookups, cached and parsed every call")
+    mode.add_argument("--calls", type=int, default=2000)
+    mode.add_argument("--configs", type=int, default=5000, help="Lookups in a tick")
+    harness.add_arguments(mode)
+
+    mode = modes.add_parser("render", help="Notification render time per tick")
+    mode.add_argument("--streamers", type=int, default=500, help="All live")
+    mode.add_argument("--sizes", type=int, nargs="+", default=[500, 2000, 10000], help="Configs")
+    mode.add_argument("--ticks", type=int, default=5)
+    harness.add_arguments(mode)
+
+    mode = modes.add_parser("promos", help="promotional_messages throughput")
+    mode.add_argument("--messages", type=int, default=5000, help="MessageCreate events per run")
+    mode.add_argument("--promo-shares", type=float, nargs="+", default=[0.0, 0.2, 1.0],
+                      help="Share of messages sent to promo channels, a run each")
+    mode.add_argument("--guilds", type=int, default=1000)
+    mode.add_argument("--promo-guilds", type=float, default=0.3, help="Share of guilds with promotions enabled")
+    mode.add_argument("--streamers", type=int, default=1000)
+    mode.add_argument("--live-fraction", type=float, default=0.1)
+    mode.add_argument("--concurrency", type=int, default=100)
+    mode.add_argument("--discord-latency", type=float, default=0.05, help="Seconds")
+    harness.add_arguments(mode)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
+    random.seed(args.seed)
+
+    ok = {'roundtrips': roundtrips, 'helix': helix, 'templates': templates, 'render': render, 'promos': promos}[args.mode](args)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
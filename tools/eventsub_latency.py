@@ -0,0 +1,183 @@
+"""
+EventSub go live latency, from Twitch sending `stream.online` to Discord returning the created announcement.
+
+Starts a fake EventSub WebSocket next to the fake Twitch and Discord from the load test, lets the real EventSubClient
+connect and subscribe, then flips streamers live and offline so the fake pushes notifications. The poll loop and
+outbound workers run alongside like they do in the bot. Every announcement Discord returns is matched with the
+notification that started it.
+
+    poetry run python tools/eventsub_latency.py --streamers 300 --configs 600 --ticks 20
+    poetry run python tools/eventsub_latency.py --record notifications.jsonl
+    poetry run python tools/eventsub_latency.py --replay notifications.jsonl --speed 10
+
+--replay takes notifications recorded with --record, or captured off a real EventSub connection one message per line,
+and plays them back with their original spacing (divided by --speed).
+"""
+import harness
+
+import argparse
+import bisect
+import json
+import logging
+import random
+import sys
+import time
+
+import gevent
+
+from harness import FakeTwitch, FakeDiscord, FakeEventSub, percentile
+
+log = logging.getLogger("eventsub_latency")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    # Every subscription is a Helix request, past ~400 streamers subscribing waits on the 800/min budget
+    parser.add_argument("--streamers", type=int, default=200)
+    parser.add_argument("--configs", type=int, default=300, help="Stream configs (guild notifications)")
+    parser.add_argument("--ticks", type=int, default=10, help="Churns, without --replay")
+    parser.add_argument("--tick-interval", type=float, default=5, help="Seconds between churns")
+    parser.add_argument("--churn", type=float, default=0.02, help="Share of streamers going live/offline per churn")
+    parser.add_argument("--check-interval", type=float, default=30, help="Poll loop interval, seconds")
+    parser.add_argument("--replay", help="Play back recorded notifications instead of churning")
+    parser.add_argument("--speed", type=float, default=1, help="Replay this many times faster")
+    parser.add_argument("--record", help="Write every notification sent to this file")
+    parser.add_argument("--workers", type=int, default=10, help="Outbound worker greenlets")
+    parser.add_argument("--helix-latency", type=float, default=0.05, help="Seconds")
+    parser.add_argument("--discord-latency", type=float, default=0.1, help="Seconds")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="Seconds to wait for the outbound queue")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    harness.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    random.seed(args.seed)
+
+    replay = FakeEventSub.load_replay(args.replay) if args.replay else None
+    twitch_fake = FakeTwitch(0 if replay else args.streamers, 0, latency=args.helix_latency)
+    for _, _, user_id, login in replay or []:
+        twitch_fake.add_streamer(user_id, login)
+    discord_fake = FakeDiscord(latency=args.discord_latency)
+    eventsub_fake = FakeEventSub(twitch_fake)
+    if args.record:
+        eventsub_fake.recording = open(args.record, "w")
+
+    twitch_address = harness.serve(twitch_fake.app)
+    discord_address = harness.serve(discord_fake.app)
+    eventsub_url = harness.serve_eventsub(eventsub_fake)
+
+    harness.prepare_workdir(
+        args, check_interval=args.check_interval, live_update_interval=60, rouge_key_removal_interval=86400,
+        eventsub={'enabled': True, 'url': eventsub_url, 'sync_interval': 30, 'reconcile_interval': 300},
+        outbound={'workers': args.workers, 'backoff_base': 0.1, 'backoff_max': 2})
+    announcements = harness.load_bot()
+    outbound = announcements.outbound
+
+    from TavernCrier.redis import rdb
+    from TavernCrier.util.cache import stream_configs
+    from TavernCrier.util.eventsub import EventSubClient
+    from TavernCrier.util.loop import PollLoop
+
+    rdb.flushdb()
+    api = harness.redirect(twitch_address, discord_address)
+
+    configs = harness.generate_configs(twitch_fake.streamers, args.configs)
+    harness.seed_stream_configs(configs)
+    channel_users = {config['channel']: user_id for user_id, cfgs in configs.items() for config in cfgs}
+
+    # When Discord handed back each announcement, by channel
+    posted = []
+    create = api.channels_messages_create
+
+    def timed_create(channel, *a, **kw):
+        message = create(channel, *a, **kw)
+        posted.append((str(channel), time.time()))
+        return message
+    api.channels_messages_create = timed_create
+
+    plugin = harness.make_plugin(api)
+    plugin.eventsub = EventSubClient(lambda: list(stream_configs.get()), plugin.on_stream_online,
+                                     plugin.on_stream_offline, url=eventsub_url, sync_interval=30)
+    outbound.handler("announce", plugin.send_announcement)
+    outbound.handler("live_update", plugin.send_live_update)
+    outbound.handler("end_action", plugin.run_end_action)
+
+    greenlets = [gevent.spawn(plugin.eventsub.run), gevent.spawn(plugin.eventsub.sync_loop)]
+    greenlets += [gevent.spawn(outbound.work) for _ in range(outbound.workers)]
+
+    # Everyone has to be subscribed before a notification can reach us
+    wanted = len(configs) * len(EventSubClient.SUBSCRIPTION_TYPES)
+    started = time.perf_counter()
+    while len(plugin.eventsub.subscriptions) < wanted:
+        if time.perf_counter() - started > 60:
+            print(f"Only {len(plugin.eventsub.subscriptions)}/{wanted} subscriptions after 60s", file=sys.stderr)
+            sys.exit(1)
+        gevent.sleep(0.1)
+    subscribe_seconds = time.perf_counter() - started
+
+    greenlets.append(gevent.spawn(PollLoop("stream_grab", plugin.stream_grab_schedule, args.check_interval).run))
+
+    run_started = time.time()
+    if replay:
+        for offset, sub_type, user_id, _ in replay:
+            gevent.sleep(max(0.0, run_started + offset / args.speed - time.time()))
+            if sub_type == "stream.online" and user_id not in twitch_fake.live:
+                twitch_fake.go_live(user_id)
+            elif sub_type == "stream.offline" and user_id in twitch_fake.live:
+                twitch_fake.go_offline(user_id)
+    else:
+        for _ in range(args.ticks):
+            twitch_fake.churn(args.churn)
+            gevent.sleep(args.tick_interval)
+
+    started = time.perf_counter()
+    while time.perf_counter() - started < args.drain_timeout:
+        depth = outbound.metrics()
+        if not depth['ready'] and not depth['delayed'] and not depth['inflight']:
+            break
+        gevent.sleep(0.05)
+    run_seconds = time.time() - run_started
+    gevent.killall(greenlets)
+    if eventsub_fake.recording:
+        eventsub_fake.recording.close()
+
+    # Each announcement against the last stream.online its streamer was sent before Discord returned it
+    online = {}
+    for sub_type, user_id, _, sent_at in eventsub_fake.sent:
+        if sub_type == "stream.online":
+            online.setdefault(user_id, []).append(sent_at)
+    latencies = []
+    for channel, returned_at in posted:
+        sent = online.get(channel_users.get(channel), [])
+        i = bisect.bisect(sent, returned_at)
+        if i:
+            latencies.append(returned_at - sent[i - 1])
+
+    notifications = {sub_type: sum(1 for sent in eventsub_fake.sent if sent[0] == sub_type)
+                     for sub_type in EventSubClient.SUBSCRIPTION_TYPES}
+    report = {
+        'streamers': len(twitch_fake.streamers), 'configs': args.configs, 'run_seconds': run_seconds,
+        'subscribe_seconds': subscribe_seconds, 'notifications': notifications,
+        'notifications_missed': dict(eventsub_fake.missed), 'announcements': len(latencies),
+        'event_to_post_seconds': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                                  'p99': percentile(latencies, 99), 'max': max(latencies, default=0)},
+        'helix_requests': {f"{path} {status}": count for (path, status), count in sorted(twitch_fake.requests.items())},
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        e = report['event_to_post_seconds']
+        print(f"{report['streamers']} streamers, {args.configs} configs, subscribed in {subscribe_seconds:.1f}s, "
+              f"ran {run_seconds:.1f}s")
+        print("Notifications: " + ", ".join(f"{k}: {v}" for k, v in notifications.items()) +
+              (f" (not subscribed to: {report['notifications_missed']})" if eventsub_fake.missed else ""))
+        print(f"Event -> post: {len(latencies)} announcements  p50 {e['p50']:.3f}s  p95 {e['p95']:.3f}s  "
+              f"p99 {e['p99']:.3f}s  max {e['max']:.3f}s")
+        print("Helix requests: " + ", ".join(f"{k}: {v}" for k, v in report['helix_requests'].items()))
+
+    sys.exit(0 if latencies or not notifications['stream.online'] else 1)
+
+
+if __name__ == "__main__":
+    main()
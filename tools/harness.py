@@ -0,0 +1,722 @@
+"""
+Fake Twitch (OAuth, Helix, EventSub WebSocket) and Discord REST servers, and the plumbing to run the bot's real code
+against them. Shared by the load test and benchmarks in this directory, nothing here talks to the outside world.
+
+Import this before anything else, it monkey patches for gevent.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import atexit
+import base64
+import hashlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+import gevent
+import yaml
+from gevent.lock import Semaphore
+from gevent.pywsgi import WSGIServer
+from gevent.server import StreamServer
+from requests.adapters import HTTPAdapter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def twitch_timestamp(ts, precise=False):
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ" if precise else
+                                                                "%Y-%m-%dT%H:%M:%SZ")
+
+
+def read_body(environ):
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    return json.loads(environ['wsgi.input'].read(length) or b"null") if length else None
+
+
+def respond(start_response, status, body=None, headers=None):
+    payload = json.dumps(body).encode('utf-8') if body is not None else b""
+    start_response(status, [("Content-Type", "application/json"), ("Content-Length", str(len(payload)))] +
+                   list((headers or {}).items()))
+    return [payload]
+
+
+def percentile(values, point):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, -(-point * len(values) // 100) - 1))]
+
+
+class FakeService(object):
+    def __init__(self, latency=0.0, error_rate=0.0, ratelimit_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.ratelimit_rate = ratelimit_rate
+        self.requests = Counter()
+
+    def delay(self):
+        if self.latency:
+            gevent.sleep(random.uniform(self.latency / 2, self.latency * 1.5))
+
+    def injected_failure(self):
+        roll = random.random()
+        if roll < self.ratelimit_rate:
+            return "429 Too Many Requests"
+        if roll < self.ratelimit_rate + self.error_rate:
+            return "503 Service Unavailable"
+        return None
+
+
+class FakeTwitch(FakeService):
+    def __init__(self, streamers, live_fraction, **kwargs):
+        super(FakeTwitch, self).__init__(**kwargs)
+        self.streamers = [str(100000 + i) for i in range(streamers)]
+        self.logins = {}
+        self.live = {}
+        self.sessions = []
+        self.ended = {}
+        self.offline_at = {}
+        # (type, user_id): (subscription id, session id)
+        self.subscriptions = {}
+        self.eventsub = None
+        self._next_stream_id = 1
+        for user_id in random.sample(self.streamers, int(streamers * live_fraction)):
+            self.go_live(user_id)
+
+    def login(self, user_id):
+        return self.logins.get(user_id, f"streamer{user_id}")
+
+    def add_streamer(self, user_id, login=None):
+        if user_id not in self.streamers:
+            self.streamers.append(user_id)
+        if login:
+            self.logins[user_id] = login
+
+    def go_live(self, user_id, stream_id=None):
+        if stream_id is None:
+            stream_id = str(self._next_stream_id)
+            self._next_stream_id += 1
+        login = self.login(user_id)
+        self.live[user_id] = {
+            'id': stream_id, 'user_id': user_id, 'user_login': login, 'user_name': login.title(),
+            'game_name': "Just Chatting", 'type': "live", 'title': f"Load test stream {stream_id}", 'viewer_count': 0,
+            'started_at': twitch_timestamp(time.time()), 'is_mature': False, 'tags': ["LoadTest"],
+            'thumbnail_url': f"https://example.invalid/{user_id}-{{width}}x{{height}}.jpg"
+        }
+        self.sessions.append((user_id, stream_id))
+        if self.eventsub:
+            self.eventsub.notify("stream.online", self.live[user_id])
+
+    def go_offline(self, user_id):
+        stream = self.live.pop(user_id)
+        self.ended[user_id] = stream['id']
+        self.offline_at[self.login(user_id)] = time.monotonic()
+        if self.eventsub:
+            self.eventsub.notify("stream.offline", stream)
+
+    def churn(self, rate, relist=0.0):
+        """
+        Flips `rate` of the streamers live or offline. Twitch sometimes lists an ended stream again under the same
+        id, `relist` of the ones going live do that.
+        """
+        flips = random.sample(self.streamers, int(len(self.streamers) * rate))
+        for user_id in flips:
+            if user_id in self.live:
+                self.go_offline(user_id)
+            elif user_id in self.ended and random.random() < relist:
+                self.go_live(user_id, self.ended[user_id])
+            else:
+                self.go_live(user_id)
+
+    def app(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ['PATH_INFO']
+        query = parse_qs(environ.get('QUERY_STRING', ""))
+        body = read_body(environ)
+        self.delay()
+
+        if path.startswith("/oauth2/"):
+            self.requests[(path, 200)] += 1
+            if path == "/oauth2/validate":
+                return respond(start_response, "200 OK", {'expires_in': 3600})
+            return respond(start_response, "200 OK", {'access_token': "fake", 'refresh_token': "fake",
+                                                      'expires_in': 3600})
+
+        failure = self.injected_failure()
+        if failure:
+            self.requests[(path, int(failure[:3]))] += 1
+            return respond(start_response, failure, {'error': failure},
+                           {'Ratelimit-Limit': "800", 'Ratelimit-Remaining': "0",
+                            'Ratelimit-Reset': str(int(time.time()) + 1)})
+
+        headers = {'Ratelimit-Limit': "800", 'Ratelimit-Remaining': "799", 'Ratelimit-Reset': str(int(time.time()) + 60)}
+
+        if path == "/helix/eventsub/subscriptions":
+            return self.subscription_app(method, query, body, start_response, headers)
+
+        self.requests[(path, 200)] += 1
+
+        if path == "/helix/streams":
+            data = []
+            logins = {login.lower() for login in query.get('user_login', [])}
+            user_ids = query.get('user_id', []) + [user_id for user_id in self.live
+                                                   if self.login(user_id) in logins]
+            for user_id in user_ids:
+                stream = self.live.get(user_id)
+                if stream:
+                    # Something for live updates to pick up
+                    stream['viewer_count'] = random.randint(0, 10000)
+                    data.append(dict(stream))
+            return respond(start_response, "200 OK", {'data': data}, headers)
+
+        if path == "/helix/users":
+            data = [{'id': user_id, 'login': self.login(user_id), 'display_name': self.login(user_id).title(),
+                     'profile_image_url': f"https://example.invalid/{user_id}.png"} for user_id in query.get('id', [])]
+            return respond(start_response, "200 OK", {'data': data}, headers)
+
+        if path == "/helix/videos":
+            user_id = query.get('user_id', [None])[0]
+            data = []
+            if user_id in self.ended:
+                data.append({'id': f"v{self.ended[user_id]}", 'stream_id': self.ended[user_id], 'user_id': user_id,
+                             'url': f"https://example.invalid/videos/{self.ended[user_id]}"})
+            return respond(start_response, "200 OK", {'data': data}, headers)
+
+        return respond(start_response, "404 Not Found", {'error': "Not Found"}, headers)
+
+    def subscription_app(self, method, query, body, start_response, headers):
+        path = "/helix/eventsub/subscriptions"
+        if method == "DELETE":
+            sub_id = query.get('id', [None])[0]
+            for key, (existing_id, _) in list(self.subscriptions.items()):
+                if existing_id == sub_id:
+                    del self.subscriptions[key]
+                    self.requests[(path, 204)] += 1
+                    return respond(start_response, "204 No Content", None, headers)
+            self.requests[(path, 404)] += 1
+            return respond(start_response, "404 Not Found", {'error': "Not Found"}, headers)
+
+        key = (body['type'], body['condition']['broadcaster_user_id'])
+        if key in self.subscriptions:
+            self.requests[(path, 409)] += 1
+            return respond(start_response, "409 Conflict", {'error': "Conflict",
+                                                            'message': "subscription already exists"}, headers)
+
+        sub_id = uuid.uuid4().hex
+        self.subscriptions[key] = (sub_id, body['transport']['session_id'])
+        self.requests[(path, 202)] += 1
+        return respond(start_response, "202 Accepted", {'data': [dict(body, id=sub_id, status="enabled", cost=0,
+                                                                      created_at=twitch_timestamp(time.time()))],
+                                                        'total': len(self.subscriptions), 'total_cost': 0,
+                                                        'max_total_cost': 10}, headers)
+
+
+class FakeEventSub(object):
+    """
+    EventSub WebSocket server for FakeTwitch. Pushes `stream.online`/`stream.offline` to whichever session holds
+    the subscription whenever a fake streamer goes live or offline, and records every notification it sends.
+    """
+
+    def __init__(self, twitch, keepalive=10):
+        self.twitch = twitch
+        self.keepalive = keepalive
+        self.sessions = {}
+        # (type, user_id, stream_id, sent at)
+        self.sent = []
+        self.missed = Counter()
+        self.recording = None
+        twitch.eventsub = self
+
+    def message(self, message_type, payload, subscription_type=None):
+        metadata = {'message_id': uuid.uuid4().hex, 'message_type': message_type,
+                    'message_timestamp': twitch_timestamp(time.time(), precise=True)}
+        if subscription_type:
+            metadata.update(subscription_type=subscription_type, subscription_version="1")
+        return {'metadata': metadata, 'payload': payload}
+
+    @staticmethod
+    def frame(data):
+        payload = json.dumps(data).encode('utf-8')
+        if len(payload) < 126:
+            header = bytes([0x81, len(payload)])
+        elif len(payload) < 65536:
+            header = bytes([0x81, 126]) + len(payload).to_bytes(2, "big")
+        else:
+            header = bytes([0x81, 127]) + len(payload).to_bytes(8, "big")
+        return header + payload
+
+    def send(self, session_id, data):
+        sock, lock = self.sessions[session_id]
+        with lock:
+            sock.sendall(self.frame(data))
+
+    def handle(self, sock, address):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return
+            request += chunk
+
+        headers = dict(line.split(": ", 1) for line in request.decode('latin-1').split("\r\n")[1:] if ": " in line)
+        key = {name.lower(): value for name, value in headers.items()}['sec-websocket-key'].strip()
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()).decode('ascii')
+        sock.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode('ascii'))
+
+        session_id = uuid.uuid4().hex
+        self.sessions[session_id] = (sock, Semaphore())
+        # Nothing the client sends matters, just notice when it goes away.
+        reader = gevent.spawn(lambda: [None for _ in iter(lambda: sock.recv(4096), b"")])
+        try:
+            self.send(session_id, self.message("session_welcome", {'session': {
+                'id': session_id, 'status': "connected", 'keepalive_timeout_seconds': self.keepalive,
+                'reconnect_url': None, 'connected_at': twitch_timestamp(time.time(), precise=True)}}))
+            while not reader.ready():
+                reader.join(timeout=self.keepalive)
+                if not reader.ready():
+                    self.send(session_id, self.message("session_keepalive", {}))
+        except OSError:
+            pass
+        finally:
+            del self.sessions[session_id]
+            reader.kill()
+
+    def notify(self, sub_type, stream):
+        subscription = self.twitch.subscriptions.get((sub_type, stream['user_id']))
+        if not subscription or subscription[1] not in self.sessions:
+            self.missed[sub_type] += 1
+            return
+
+        sub_id, session_id = subscription
+        event = {'broadcaster_user_id': stream['user_id'], 'broadcaster_user_login': stream['user_login'],
+                 'broadcaster_user_name': stream['user_name']}
+        if sub_type == "stream.online":
+            event.update(id=stream['id'], type="live", started_at=stream['started_at'])
+
+        message = self.message("notification", {
+            'subscription': {'id': sub_id, 'status': "enabled", 'type': sub_type, 'version': "1", 'cost': 0,
+                             'condition': {'broadcaster_user_id': stream['user_id']},
+                             'transport': {'method': "websocket", 'session_id': session_id},
+                             'created_at': twitch_timestamp(time.time())},
+            'event': event
+        }, subscription_type=sub_type)
+        self.sent.append((sub_type, stream['user_id'], stream['id'], time.time()))
+        if self.recording:
+            self.recording.write(json.dumps(message) + "\n")
+        try:
+            self.send(session_id, message)
+        except OSError:
+            self.missed[sub_type] += 1
+
+    @staticmethod
+    def load_replay(path) -> list:
+        """
+        Notifications recorded with --eventsub-record, or captured from Twitch, one message per line. Returns
+        (seconds since the first message, subscription type, user id, login) for each.
+        """
+        events = []
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                if message['metadata']['message_type'] != "notification":
+                    continue
+                sent_at = datetime.fromisoformat(message['metadata']['message_timestamp'][:26].rstrip("Z") +
+                                                 "+00:00").timestamp()
+                event = message['payload']['event']
+                events.append((sent_at, message['payload']['subscription']['type'], event['broadcaster_user_id'],
+                               event['broadcaster_user_login']))
+
+        first = events[0][0] if events else 0
+        return [(sent_at - first, sub_type, user_id, login) for sent_at, sub_type, user_id, login in events]
+
+
+class FakeDiscord(FakeService):
+    def __init__(self, **kwargs):
+        super(FakeDiscord, self).__init__(**kwargs)
+        self.messages = {}
+        self.creates = Counter()
+        self.ended = set()
+        # Ended messages edited back to something else, they should stay ended
+        self.edited_after_end = 0
+        self.nonces = {}
+        self._next_id = 1
+
+    def app(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        # /api/v10/channels/{channel}/messages[/{message}]
+        parts = environ['PATH_INFO'].strip("/").split("/")
+        channel_id = parts[3] if len(parts) > 3 else None
+        message_id = parts[5] if len(parts) > 5 else None
+        body = read_body(environ)
+        self.delay()
+
+        ratelimit_headers = {'X-RateLimit-Limit': "1000", 'X-RateLimit-Remaining': "999",
+                             'X-RateLimit-Reset': str(time.time() + 1), 'X-RateLimit-Reset-After': "1",
+                             'X-RateLimit-Bucket': f"fake-{channel_id}"}
+
+        failure = self.injected_failure()
+        if failure:
+            self.requests[(method, int(failure[:3]))] += 1
+            if failure.startswith("429"):
+                return respond(start_response, failure,
+                               {'message': "You are being rate limited.", 'retry_after': 0.05, 'global': False},
+                               dict(ratelimit_headers, **{'Retry-After': "0.05", 'X-RateLimit-Remaining': "0",
+                                                          'X-RateLimit-Scope': "user"}))
+            return respond(start_response, failure, {'message': failure, 'code': 0}, ratelimit_headers)
+
+        if method == "POST" and message_id is None:
+            nonce = (body or {}).get('nonce')
+            if nonce and (body or {}).get('enforce_nonce') and nonce in self.nonces:
+                # Discord hands back the message it already created for the nonce
+                self.requests[(method, 200)] += 1
+                return respond(start_response, "200 OK", self.message(self.nonces[nonce], channel_id, body),
+                               ratelimit_headers)
+
+            message_id = str(self._next_id)
+            self._next_id += 1
+            marker = (body or {}).get('content', "").rsplit(" ", 1)[-1]
+            self.messages[message_id] = marker
+            self.creates[marker] += 1
+            if nonce:
+                self.nonces[nonce] = message_id
+            self.requests[(method, 200)] += 1
+            return respond(start_response, "200 OK", self.message(message_id, channel_id, body), ratelimit_headers)
+
+        if method == "DELETE" and message_id and message_id.startswith("user-"):
+            # Someone's promo message, deleted once it's been reposted
+            self.requests[(method, 204)] += 1
+            return respond(start_response, "204 No Content", None, ratelimit_headers)
+
+        if message_id not in self.messages:
+            self.requests[(method, 404)] += 1
+            return respond(start_response, "404 Not Found", {'message': "Unknown Message", 'code': 10008},
+                           ratelimit_headers)
+
+        self.requests[(method, 200)] += 1
+        if method == "DELETE":
+            self.ended.add(message_id)
+            return respond(start_response, "204 No Content", None, ratelimit_headers)
+
+        if "ended" in (body or {}).get('content', ""):
+            self.ended.add(message_id)
+        elif message_id in self.ended:
+            self.ended.discard(message_id)
+            self.edited_after_end += 1
+        return respond(start_response, "200 OK", self.message(message_id, channel_id, body), ratelimit_headers)
+
+    @staticmethod
+    def message(message_id, channel_id, body):
+        embeds = [dict(embed) for embed in body.get('embeds') or []]
+        for embed in embeds:
+            # Discord hands embed timestamps back in UTC
+            if embed.get('timestamp'):
+                embed['timestamp'] = datetime.fromisoformat(embed['timestamp']).astimezone(timezone.utc).isoformat()
+        return {
+            'id': message_id, 'channel_id': channel_id, 'type': 0, 'content': body.get('content', ""),
+            'author': {'id': "1", 'username': "TavernCrier", 'discriminator': "0"},
+            'timestamp': datetime.now(tz=timezone.utc).isoformat(), 'embeds': embeds,
+            'components': body.get('components') or [], 'attachments': [], 'mentions': [], 'mention_roles': [],
+            'pinned': False, 'tts': False, 'mention_everyone': False
+        }
+
+
+class RedirectAdapter(HTTPAdapter):
+    """
+    Sends requests meant for a real API to one of the fake servers instead.
+    """
+
+    def __init__(self, address, **kwargs):
+        super(RedirectAdapter, self).__init__(**kwargs)
+        self.address = address
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = urlunsplit(("http", self.address, url.path, url.query, url.fragment))
+        return super(RedirectAdapter, self).send(request, **kwargs)
+
+
+def serve(app):
+    server = WSGIServer(("127.0.0.1", 0), app, log=None)
+    server.start()
+    return f"127.0.0.1:{server.server_port}"
+
+
+def serve_eventsub(eventsub):
+    server = StreamServer(("127.0.0.1", 0), eventsub.handle)
+    server.start()
+    return f"ws://127.0.0.1:{server.server_port}/ws"
+
+
+def start_fakeredis():
+    """
+    Runs fakeredis as a redis server in a child process, for boxes without one. Needs `fakeredis` and `lupa`.
+    Returns the process and its port.
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    process = subprocess.Popen([sys.executable, "-c",
+                                "import sys\nfrom fakeredis import TcpFakeServer\n"
+                                "TcpFakeServer(('127.0.0.1', int(sys.argv[1])), server_type='redis').serve_forever()",
+                                str(port)])
+    atexit.register(process.kill)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("fakeredis didn't start")
+
+
+def add_arguments(parser):
+    parser.add_argument("--redis-host", default="127.0.0.1")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=14, help="Wiped before the run!")
+    parser.add_argument("--fakeredis", action="store_true",
+                        help="Run against fakeredis in a child process instead (pip install fakeredis lupa)")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def prepare_workdir(args, **config):
+    """
+    Writes a config.yaml pointing at the redis from `args` into a fresh working directory and moves into it, since
+    the bot reads ./config.yaml and ./data on import. Keyword arguments are added to the config.
+    """
+    if args.fakeredis:
+        args.fakeredis_process, args.redis_port = start_fakeredis()
+        args.redis_host = "127.0.0.1"
+
+    config = dict({
+        'token': "fake", 'enforce_whitelist': False, 'logging_channel': 1,
+        'twitch_login': {'client_id': "fake", 'client_secret': "fake", 'refresh_token': "fake"},
+        'database_info': {
+            'redis': {'host': args.redis_host, 'port': args.redis_port, 'db': args.redis_db},
+            # Never connected to, see load_bot()
+            'postgres': {'host': "127.0.0.1", 'port': 5432, 'username': "loadtest", 'password': "loadtest",
+                         'database': "loadtest"}
+        }
+    }, **config)
+
+    workdir = tempfile.mkdtemp(prefix="taverncrier-loadtest-")
+    with open(os.path.join(workdir, "config.yaml"), "w") as f:
+        yaml.safe_dump(config, f)
+    os.symlink(os.path.join(ROOT, "data"), os.path.join(workdir, "data"))
+    enter_workdir(workdir)
+    return workdir
+
+
+def enter_workdir(workdir):
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def load_bot():
+    """
+    Imports the bot without a Postgres server. Registering a model creates its table, so registration is skipped,
+    everything that would read the tables is seeded directly instead.
+    """
+    from TavernCrier.db import PostgresBase
+    PostgresBase.register = staticmethod(lambda cls: cls)
+
+    import TavernCrier.plugins.announcements
+    return TavernCrier.plugins.announcements
+
+
+def redirect_twitch(twitch_address):
+    """
+    Points the Twitch client at the fake Twitch.
+    """
+    from TavernCrier.util.twitch import twitch
+
+    for prefix in ("https://api.twitch.tv", "https://id.twitch.tv"):
+        twitch.session.mount(prefix, RedirectAdapter(twitch_address))
+
+
+def redirect(twitch_address, discord_address):
+    """
+    Points the Twitch client at the fake Twitch, returns a Discord API client pointed at the fake Discord.
+    """
+    from disco.api.client import APIClient
+
+    redirect_twitch(twitch_address)
+    api = APIClient("fake")
+    api.http.session.mount("https://discord.com", RedirectAdapter(discord_address))
+    return api
+
+
+def make_plugin(api):
+    """
+    Just enough of an AnnouncementPlugin for the poll tick, EventSub handlers, promos and outbound handlers, without
+    a gateway connection. Sharding, leader election, adaptive polling and EventSub are off, set them on the result.
+    """
+    from TavernCrier.plugins.announcements import AnnouncementPlugin
+
+    plugin = AnnouncementPlugin.__new__(AnnouncementPlugin)
+    plugin.client = SimpleNamespace(api=api, events=SimpleNamespace(emit=lambda *a, **kw: None))
+    plugin.process_lock = Semaphore()
+    plugin.loaded_at = time.time()
+    plugin.last_reconcile = 0
+    plugin.pending_online = set()
+    plugin.poll_scheduler = None
+    plugin.eventsub = None
+    plugin.shards = None
+    plugin.leader = None
+    return plugin
+
+
+def generate_configs(streamers, count):
+    """
+    `count` stream configs spread over the streamers, each message ends in a marker the fake Discord counts by.
+    """
+    configs = {}
+    for cfg_id in range(1, count + 1):
+        user_id = random.choice(streamers)
+        configs.setdefault(user_id, []).append({
+            'id': cfg_id, 'channel': str(900000 + cfg_id), 'role': None, 'messages': [f"{{role}} Live now! {cfg_id}"],
+            'config': {'username': True, 'title': True, 'category': True, 'viewers': True, 'live_since': True,
+                       'tags': True, 'preview_image': True, 'button': True, 'mature_badge': False,
+                       'live_update': True, 'stream_end_action': random.choice([1, 2, 3])}
+        })
+    return configs
+
+
+def seed_stream_configs(configs):
+    from TavernCrier.redis import rdb
+    from TavernCrier.util.cache import stream_configs
+
+    stream_configs.configs = configs
+    stream_configs.version = rdb.get(stream_configs.VERSION_KEY) or "0"
+
+
+def seed_guild_configs(guilds, promo_fraction):
+    """
+    `guilds` guild configs, `promo_fraction` of them with promotions enabled in their own promo channel.
+    Returns the promo channel ids.
+    """
+    from TavernCrier import GuildConfig
+    from TavernCrier.redis import rdb
+    from TavernCrier.util.cache import guild_configs
+
+    configs = {}
+    for guild_id in range(1, guilds + 1):
+        # Built from a dict, every GuildConfig() shares the same default promotional_settings
+        config = GuildConfig({'promotional_settings': {'enabled': True, 'promo_channel': 700000 + guild_id}}
+                             if random.random() < promo_fraction else {})
+        configs[guild_id] = SimpleNamespace(guild_id=guild_id, config=config)
+
+    guild_configs.configs = configs
+    guild_configs._build_promo_channels()
+    guild_configs.version = rdb.get(guild_configs.VERSION_KEY) or "0"
+    guild_configs._checked_at = time.monotonic()
+    return {guild_id: cfg.config.promotional_settings.promo_channel for guild_id, cfg in configs.items()
+            if cfg.config.promotional_settings.enabled}
+
+
+class PromoTraffic(object):
+    """
+    Synthetic MessageCreate events for `promotional_messages`. Most land in channels without promotions, the rest
+    in promo channels, linking a live streamer, an offline one, someone Twitch doesn't know, or nothing at all.
+    The marker each message ends in goes into `live` if it linked a stream that was live when it was sent, or into
+    `stale` if the stream ended less than `stale_after` seconds before, the bot may still have it cached as live.
+    """
+
+    def __init__(self, twitch, guilds, promo_channels, promo_share=0.2, stale_after=60):
+        self.twitch = twitch
+        self.guilds = guilds
+        self.promo_channels = promo_channels
+        self.promo_share = promo_share
+        self.stale_after = stale_after
+        self.live = set()
+        self.stale = set()
+        self._next_id = 1
+
+    def event(self, api):
+        message_id = f"user-{self._next_id}"
+        marker = f"promo{self._next_id}"
+        self._next_id += 1
+
+        if self.promo_channels and random.random() < self.promo_share:
+            guild_id, channel_id = random.choice(list(self.promo_channels.items()))
+            roll = random.random()
+            if roll < 0.5 and self.twitch.live:
+                login = self.twitch.live[random.choice(list(self.twitch.live))]['user_login']
+            elif roll < 0.7:
+                login = self.twitch.login(random.choice(self.twitch.streamers))
+            elif roll < 0.8:
+                login = f"nobody{random.randint(0, 10 ** 6)}"
+            else:
+                login = None
+            if login and any(stream['user_login'] == login for stream in self.twitch.live.values()):
+                self.live.add(marker)
+            elif time.monotonic() - self.twitch.offline_at.get(login, float('-inf')) < self.stale_after:
+                self.stale.add(marker)
+            content = f"come watch https://twitch.tv/{login} {marker}" if login else f"just chatting {marker}"
+        else:
+            guild_id = random.randint(1, self.guilds)
+            channel_id = 800000 + random.randint(0, 10 ** 6)
+            content = f"just chatting {marker}"
+
+        return SimpleNamespace(
+            id=message_id, content=content, guild=SimpleNamespace(id=guild_id),
+            channel=SimpleNamespace(id=channel_id),
+            author=SimpleNamespace(username="chatter", avatar_url="https://example.invalid/chatter.png", bot=False),
+            delete=lambda: api.channels_messages_delete(channel_id, message_id)
+        )
+
+    def check(self, discord) -> dict:
+        """
+        Reposting a link to a stream that wasn't live, or reposting twice, is wrong. A live link that wasn't reposted
+        was either left to the poll loop by the Helix rate limiter or still in the 30s offline cache, and a stale one
+        that was reposted came from the 60s live cache, so those are only counted.
+        """
+        reposts = Counter({marker: count for marker, count in discord.creates.items() if marker.startswith("promo")})
+        wrong = len(set(reposts) - self.live - self.stale) + sum(count - 1 for count in reposts.values())
+        return {'promo_links_to_live': len(self.live), 'promo_reposts': sum(reposts.values()),
+                'promo_wrong_reposts': wrong, 'promo_missed': len(self.live - set(reposts)),
+                'promo_stale_reposts': len(self.stale & set(reposts))}
+
+
+def announcement_creates(discord) -> Counter:
+    return Counter({marker: count for marker, count in discord.creates.items() if not marker.startswith("promo")})
+
+
+def check_announcements(twitch, discord, configs) -> dict:
+    """
+    Every stream session should be announced once per config of its streamer, and every message ended and left
+    that way.
+    """
+    expected = Counter()
+    for user_id, _ in twitch.sessions:
+        for config in configs.get(user_id, []):
+            expected[str(config['id'])] += 1
+
+    creates = announcement_creates(discord)
+    duplicates = sum(max(count - expected[marker], 0) for marker, count in creates.items())
+    missing = sum(max(count - creates[marker], 0) for marker, count in expected.items())
+    not_ended = len({mid for mid, marker in discord.messages.items() if not marker.startswith("promo")} -
+                    discord.ended)
+    return {'expected_announcements': sum(expected.values()), 'announcements': sum(creates.values()),
+            'duplicates': duplicates, 'missing': missing, 'not_ended': not_ended,
+            'edited_after_end': discord.edited_after_end}
+
@@ -0,0 +1,377 @@
+"""
+Offline load test for the announcement pipeline.
+
+Starts a fake Twitch (OAuth, helix/streams, helix/users, helix/videos) and a fake Discord REST API on localhost,
+generates streamers, stream configs and guild configs, and drives poll ticks through the real AnnouncementPlugin code
+and outbound workers. After every tick a burst of synthetic MessageCreate events goes through promotional_messages.
+Nothing leaves the machine, the only thing it needs is a local redis (or --fakeredis). The redis database given is
+wiped.
+
+    poetry run python tools/loadtest.py --streamers 2000 --configs 5000 --ticks 20 --discord-error-rate 0.02
+
+Reports tick latency, delivery throughput, promo messages/sec, request counts and whether every stream was announced
+and ended exactly once per config.
+
+With --processes the ticks aren't driven from here. That many bot processes run their own poll loops with sharding
+on, short leases and a short visibility timeout, while streamers churn underneath them. Halfway through one of them is
+SIGKILLed and replaced, and at the end every stream should still have been announced and ended exactly once.
+
+    poetry run python tools/loadtest.py --processes 3 --streamers 500 --configs 1000 --ticks 20
+"""
+import harness
+
+import argparse
+import atexit
+import json
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+import gevent
+from gevent.pool import Pool
+
+from harness import FakeTwitch, FakeDiscord, PromoTraffic, percentile
+
+log = logging.getLogger("loadtest")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streamers", type=int, default=1000)
+    parser.add_argument("--configs", type=int, default=2000, help="Stream configs (guild notifications)")
+    parser.add_argument("--guilds", type=int, default=500)
+    parser.add_argument("--promo-guilds", type=float, default=0.3, help="Share of guilds with promotions enabled")
+    parser.add_argument("--promo-messages", type=int, default=2000, help="MessageCreate events per tick")
+    parser.add_argument("--promo-share", type=float, default=0.2, help="Share of messages sent to promo channels")
+    parser.add_argument("--promo-concurrency", type=int, default=100)
+    parser.add_argument("--ticks", type=int, default=10)
+    parser.add_argument("--live-fraction", type=float, default=0.1, help="Share of streamers live at the start")
+    parser.add_argument("--churn", type=float, default=0.02, help="Share of streamers going live/offline per tick")
+    parser.add_argument("--relist", type=float, default=0.1,
+                        help="Share of go lives that relist the streamer's last stream under the same id")
+    parser.add_argument("--workers", type=int, default=10, help="Outbound worker greenlets")
+    parser.add_argument("--poll-concurrency", type=int, default=4)
+    parser.add_argument("--helix-latency", type=float, default=0.05, help="Seconds")
+    parser.add_argument("--helix-error-rate", type=float, default=0.0)
+    parser.add_argument("--helix-ratelimit-rate", type=float, default=0.0)
+    parser.add_argument("--discord-latency", type=float, default=0.1, help="Seconds")
+    parser.add_argument("--discord-error-rate", type=float, default=0.0)
+    parser.add_argument("--discord-ratelimit-rate", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=120, help="Seconds to wait for the outbound queue")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--processes", type=int, default=0, help="Run this many sharded bot processes instead")
+    parser.add_argument("--tick-timeout", type=float, default=30,
+                        help="Seconds the processes get to see each churn with --processes")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--twitch-address", help=argparse.SUPPRESS)
+    parser.add_argument("--discord-address", help=argparse.SUPPRESS)
+    parser.add_argument("--configs-file", help=argparse.SUPPRESS)
+    harness.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    # Promos are sent with more concurrency than the Discord client's connection pool, that's fine here
+    logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
+    random.seed(args.seed)
+
+    if args.worker:
+        run_worker(args)
+    elif args.processes:
+        run_processes(args)
+    else:
+        run(args)
+
+
+def run(args):
+
+    twitch_fake = FakeTwitch(args.streamers, args.live_fraction, latency=args.helix_latency,
+                             error_rate=args.helix_error_rate, ratelimit_rate=args.helix_ratelimit_rate)
+    discord_fake = FakeDiscord(latency=args.discord_latency, error_rate=args.discord_error_rate,
+                               ratelimit_rate=args.discord_ratelimit_rate)
+    twitch_address = harness.serve(twitch_fake.app)
+    discord_address = harness.serve(discord_fake.app)
+
+    harness.prepare_workdir(
+        args, check_interval=30,
+        # Every tick edits live messages, so edits are part of the load
+        live_update_interval=0, live_update_force_refresh_interval=0, rouge_key_removal_interval=86400,
+        twitch_api={'poll_concurrency': args.poll_concurrency},
+        outbound={'workers': args.workers, 'backoff_base': 0.1, 'backoff_max': 2})
+    announcements = harness.load_bot()
+    outbound = announcements.outbound
+
+    from TavernCrier.redis import rdb
+
+    rdb.flushdb()
+    api = harness.redirect(twitch_address, discord_address)
+
+    configs = harness.generate_configs(twitch_fake.streamers, args.configs)
+    harness.seed_stream_configs(configs)
+    promo_channels = harness.seed_guild_configs(args.guilds, args.promo_guilds)
+    promo_traffic = PromoTraffic(twitch_fake, args.guilds, promo_channels, args.promo_share)
+
+    plugin = harness.make_plugin(api)
+    outbound.handler("announce", plugin.send_announcement)
+    outbound.handler("live_update", plugin.send_live_update)
+    outbound.handler("end_action", plugin.run_end_action)
+    workers = [gevent.spawn(outbound.work) for _ in range(outbound.workers)]
+
+    def drain():
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.drain_timeout:
+            depth = outbound.metrics()
+            if not depth['ready'] and not depth['delayed'] and not depth['inflight']:
+                break
+            gevent.sleep(0.05)
+        return time.perf_counter() - started
+
+    def promote():
+        events = [promo_traffic.event(api) for _ in range(args.promo_messages)]
+        started = time.perf_counter()
+        pool = Pool(args.promo_concurrency)
+        for event in events:
+            pool.spawn(plugin.promotional_messages, event)
+        pool.join()
+        return time.perf_counter() - started
+
+    tick_seconds = []
+    drain_seconds = []
+    promo_seconds = []
+    failed_ticks = 0
+    run_started = time.perf_counter()
+    for tick in range(args.ticks + 1):
+        if tick == args.ticks:
+            # Last tick ends every stream, so every announcement should get its end action.
+            for user_id in list(twitch_fake.live):
+                twitch_fake.go_offline(user_id)
+        elif tick:
+            twitch_fake.churn(args.churn, args.relist)
+
+        # A failed tick is retried before anything changes, like the poll loop would after backing off. Otherwise
+        # a stream that only lasted that tick would never be seen.
+        started = time.perf_counter()
+        for attempt in range(10):
+            if plugin.stream_grab_schedule() is not False:
+                break
+            failed_ticks += 1
+        tick_seconds.append(time.perf_counter() - started)
+        drain_seconds.append(drain())
+        if tick < args.ticks and args.promo_messages:
+            promo_seconds.append(promote())
+    run_seconds = time.perf_counter() - run_started
+
+    gevent.killall(workers)
+
+    correctness = harness.check_announcements(twitch_fake, discord_fake, configs)
+    correctness['dead_letters'] = rdb.llen(outbound.dead_key)
+    correctness.update(promo_traffic.check(discord_fake))
+    stats = rdb.hgetall("stats")
+
+    sent = sum(count for (method, status), count in discord_fake.requests.items() if status < 300)
+    promo_total = args.promo_messages * len(promo_seconds)
+    report = {
+        'streamers': args.streamers, 'configs': args.configs, 'guilds': args.guilds, 'ticks': args.ticks,
+        'failed_ticks': failed_ticks, 'stream_sessions': len(twitch_fake.sessions),
+        'tick_seconds': {'p50': percentile(tick_seconds, 50), 'p95': percentile(tick_seconds, 95),
+                         'max': max(tick_seconds)},
+        'drain_seconds': {'p50': percentile(drain_seconds, 50), 'p95': percentile(drain_seconds, 95),
+                          'max': max(drain_seconds)},
+        'run_seconds': run_seconds,
+        'discord_calls_per_second': sent / max(sum(drain_seconds) + sum(tick_seconds) + sum(promo_seconds), 1e-9),
+        'promo_messages_per_second': promo_total / max(sum(promo_seconds), 1e-9),
+        'helix_requests': {f"{path} {status}": count for (path, status), count in sorted(twitch_fake.requests.items())},
+        'discord_requests': {f"{method} {status}": count
+                             for (method, status), count in sorted(discord_fake.requests.items())},
+        'outbound': {key[len("outbound_"):]: int(value) for key, value in stats.items() if key.startswith("outbound_")},
+        'correctness': correctness
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{args.streamers} streamers, {args.configs} configs, {args.guilds} guilds, {args.ticks} ticks "
+              f"({len(twitch_fake.sessions)} stream sessions) in {run_seconds:.1f}s")
+        print(f"Tick:  p50 {report['tick_seconds']['p50']:.3f}s  p95 {report['tick_seconds']['p95']:.3f}s  "
+              f"max {report['tick_seconds']['max']:.3f}s  ({failed_ticks} failed)")
+        print(f"Drain: p50 {report['drain_seconds']['p50']:.3f}s  p95 {report['drain_seconds']['p95']:.3f}s  "
+              f"max {report['drain_seconds']['max']:.3f}s")
+        print(f"Discord throughput: {report['discord_calls_per_second']:.1f} successful calls/s")
+        print(f"Promos: {promo_total} MessageCreate events at {report['promo_messages_per_second']:.0f} messages/s")
+        print("Helix requests:   " + ", ".join(f"{k}: {v}" for k, v in report['helix_requests'].items()))
+        print("Discord requests: " + ", ".join(f"{k}: {v}" for k, v in report['discord_requests'].items()))
+        print("Outbound jobs:    " + ", ".join(f"{k}: {v}" for k, v in report['outbound'].items()))
+        c = report['correctness']
+        print(f"Announcements: {c['announcements']}/{c['expected_announcements']}  duplicates {c['duplicates']}  "
+              f"missing {c['missing']}  not ended {c['not_ended']}  edited after end {c['edited_after_end']}  "
+              f"dead letters {c['dead_letters']}")
+        print(f"Promo reposts: {c['promo_reposts']} of {c['promo_links_to_live']} links to live streams  "
+              f"wrong {c['promo_wrong_reposts']}  missed {c['promo_missed']} (rate limited or cached offline)  "
+              f"stale {c['promo_stale_reposts']} (cached live)")
+
+    c = report['correctness']
+    correct = not (c['duplicates'] or c['missing'] or c['not_ended'] or c['edited_after_end'] or
+                   c['promo_wrong_reposts'])
+    sys.exit(0 if correct else 1)
+
+
+# Short enough that a killed process's streamers and jobs move on within a few ticks
+SHARDING = {'partitions': 16, 'heartbeat_interval': 1, 'lease_ttl': 3}
+
+
+def run_worker(args):
+    """
+    One bot process for --processes: a shard coordinator, outbound workers and the poll loop, until it's killed.
+    """
+    harness.prepare_workdir(
+        # Polls are every second here, edits at the usual pace so the queue drains between churns
+        args, check_interval=1, live_update_interval=60, rouge_key_removal_interval=86400,
+        sharding=dict(SHARDING, enabled=True),
+        twitch_api={'poll_concurrency': args.poll_concurrency},
+        outbound={'workers': args.workers, 'backoff_base': 0.1, 'backoff_max': 2, 'visibility_timeout': 5})
+    announcements = harness.load_bot()
+    outbound = announcements.outbound
+
+    from TavernCrier.util.loop import PollLoop
+    from TavernCrier.util.shard import ShardCoordinator
+
+    api = harness.redirect(args.twitch_address, args.discord_address)
+    with open(args.configs_file) as f:
+        harness.seed_stream_configs(json.load(f))
+
+    plugin = harness.make_plugin(api)
+    plugin.shards = ShardCoordinator(**SHARDING)
+    outbound.handler("announce", plugin.send_announcement)
+    outbound.handler("live_update", plugin.send_live_update)
+    outbound.handler("end_action", plugin.run_end_action)
+
+    greenlets = [gevent.spawn(plugin.shards.run)]
+    greenlets += [gevent.spawn(outbound.work) for _ in range(outbound.workers)]
+    greenlets.append(gevent.spawn(PollLoop("stream_grab", plugin.stream_grab_schedule, 1, max_backoff=2).run))
+    gevent.joinall(greenlets, raise_error=True)
+
+
+def run_processes(args):
+    twitch_fake = FakeTwitch(args.streamers, args.live_fraction, latency=args.helix_latency,
+                             error_rate=args.helix_error_rate, ratelimit_rate=args.helix_ratelimit_rate)
+    discord_fake = FakeDiscord(latency=args.discord_latency, error_rate=args.discord_error_rate,
+                               ratelimit_rate=args.discord_ratelimit_rate)
+    twitch_address = harness.serve(twitch_fake.app)
+    discord_address = harness.serve(discord_fake.app)
+
+    workdir = harness.prepare_workdir(args)
+    from TavernCrier.redis import rdb
+    from TavernCrier.util.jobs import OutboundQueue
+
+    rdb.flushdb()
+    outbound = OutboundQueue("outbound")
+
+    configs = harness.generate_configs(twitch_fake.streamers, args.configs)
+    configs_file = os.path.join(workdir, "configs.json")
+    with open(configs_file, "w") as f:
+        json.dump(configs, f)
+
+    command = [sys.executable, os.path.abspath(__file__), "--worker", "--twitch-address", twitch_address,
+               "--discord-address", discord_address, "--configs-file", configs_file,
+               "--redis-host", args.redis_host, "--redis-port", str(args.redis_port), "--redis-db", str(args.redis_db),
+               "--workers", str(args.workers), "--poll-concurrency", str(args.poll_concurrency)]
+    logs = []
+
+    def spawn():
+        log_file = open(os.path.join(workdir, f"worker-{len(logs)}.log"), "w")
+        logs.append(log_file.name)
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+        atexit.register(process.kill)
+        return process
+
+    # Waits for the processes to catch up with Twitch and send what they queued, like a drain after each tick.
+    # Otherwise a stream could be over before anyone had a chance to announce it.
+    tracked = set(configs)
+
+    def caught_up():
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.tick_timeout:
+            depth = outbound.metrics()
+            if set(rdb.hkeys("currently_live")) == tracked & twitch_fake.live.keys() and \
+                    not (depth['ready'] or depth['delayed'] or depth['inflight']):
+                return True
+            gevent.sleep(0.1)
+        return False
+
+    processes = [spawn() for _ in range(args.processes)]
+    killed = 0
+    late_ticks = 0
+    run_started = time.perf_counter()
+    for tick in range(args.ticks + 1):
+        if tick == args.ticks:
+            for user_id in list(twitch_fake.live):
+                twitch_fake.go_offline(user_id)
+        elif tick:
+            twitch_fake.churn(args.churn, args.relist)
+
+        if tick == args.ticks // 2:
+            # Likely in the middle of a tick or a send, with no chance to release leases, hand over or ack anything
+            gevent.sleep(random.random())
+            victim = processes.pop(random.randrange(len(processes)))
+            victim.send_signal(signal.SIGKILL)
+            victim.wait()
+            killed += 1
+            processes.append(spawn())
+        if not caught_up():
+            late_ticks += 1
+
+    # Settled once nobody is live in redis and the queue has been empty for a few polls
+    settled_at = None
+    started = time.perf_counter()
+    while time.perf_counter() - started < args.drain_timeout:
+        depth = outbound.metrics()
+        idle = not (depth['ready'] or depth['delayed'] or depth['inflight'] or rdb.hlen("currently_live"))
+        if not idle:
+            settled_at = None
+        elif settled_at is None:
+            settled_at = time.perf_counter()
+        elif time.perf_counter() - settled_at > 3:
+            break
+        gevent.sleep(0.25)
+    run_seconds = time.perf_counter() - run_started
+
+    for process in processes:
+        process.kill()
+
+    correctness = harness.check_announcements(twitch_fake, discord_fake, configs)
+    correctness['dead_letters'] = rdb.llen(outbound.dead_key)
+    stats = rdb.hgetall("stats")
+    report = {
+        'processes': args.processes, 'killed': killed, 'streamers': args.streamers, 'configs': args.configs,
+        'ticks': args.ticks, 'late_ticks': late_ticks, 'stream_sessions': len(twitch_fake.sessions), 'run_seconds': run_seconds,
+        'helix_requests': {f"{path} {status}": count for (path, status), count in sorted(twitch_fake.requests.items())},
+        'discord_requests': {f"{method} {status}": count
+                             for (method, status), count in sorted(discord_fake.requests.items())},
+        'outbound': {key[len("outbound_"):]: int(value) for key, value in stats.items() if key.startswith("outbound_")},
+        'correctness': correctness, 'logs': logs
+    }
+
+    c = correctness
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{args.processes} processes ({killed} killed and replaced), {args.streamers} streamers, "
+              f"{args.configs} configs, {args.ticks} ticks ({len(twitch_fake.sessions)} stream sessions, "
+              f"{late_ticks} not caught up with in {args.tick_timeout:.0f}s) in {run_seconds:.1f}s")
+        print("Helix requests:   " + ", ".join(f"{k}: {v}" for k, v in report['helix_requests'].items()))
+        print("Discord requests: " + ", ".join(f"{k}: {v}" for k, v in report['discord_requests'].items()))
+        print("Outbound jobs:    " + ", ".join(f"{k}: {v}" for k, v in report['outbound'].items()))
+        print(f"Announcements: {c['announcements']}/{c['expected_announcements']}  duplicates {c['duplicates']}  "
+              f"missing {c['missing']}  not ended {c['not_ended']}  edited after end {c['edited_after_end']}  "
+              f"dead letters {c['dead_letters']}")
+        print(f"Worker logs: {os.path.dirname(logs[0])}")
+
+    sys.exit(0 if not (late_ticks or c['duplicates'] or c['missing'] or c['not_ended'] or c['edited_after_end'])
+             else 1)
+
+
+if __name__ == "__main__":
+    main()
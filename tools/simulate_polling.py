@@ -0,0 +1,248 @@
+"""
+Replays streaming schedules through the adaptive poll scheduler and through fixed polling, and reports how long after
+going live each stream was noticed against how many Helix requests that took.
+
+The schedules are either synthetic, streamers with a few weekly slots they mostly keep, ones who stream whenever and
+ones who barely do, or the `stream_history` the bot recorded in redis. Everything before the last `--days` builds the
+streamer profiles, the last `--days` are replayed one check at a time. Nothing is written to redis.
+
+    poetry run python tools/simulate_polling.py --streamers 1000 --days 3
+    poetry run python tools/simulate_polling.py --from-redis --redis-db 0 --days 7
+
+Fixed polling is run at the bot's check interval, and at whatever interval makes as many requests as adaptive polling
+did. Live streamers are checked every tick either way, so their streams end on time.
+"""
+import harness
+
+import argparse
+import itertools
+import json
+import random
+import sys
+
+from harness import percentile
+
+DAY = 86400
+WEEK = 7 * DAY
+HELIX_MAX_IDS = 100
+
+
+def synthetic_sessions(streamers, start, end):
+    """
+    Streams between `start` and `end` for `streamers` made up streamers, {user_id: [(started, ended), ...]}.
+    """
+    sessions = {}
+    for n in range(streamers):
+        user_id = str(100000 + n)
+        kind = random.random()
+        streams = []
+        if kind < 0.6:
+            # Keeps a schedule, most weeks
+            slots = [(random.randrange(7), random.uniform(12, 23), random.uniform(2, 6))
+                     for _ in range(random.randint(2, 5))]
+            week = start - start % WEEK
+            while week < end:
+                for day, hour, hours in slots:
+                    if random.random() < 0.8:
+                        started = week + day * DAY + hour * 3600 + random.gauss(0, 900)
+                        streams.append((started, started + hours * 3600 * random.uniform(0.8, 1.2)))
+                week += WEEK
+        else:
+            # Whenever they feel like it, a couple of times a week or once a month
+            per_week = 2 if kind < 0.85 else 0.25
+            started = start + random.expovariate(per_week / WEEK)
+            while started < end:
+                streams.append((started, started + random.uniform(1, 5) * 3600))
+                started += random.expovariate(per_week / WEEK)
+
+        sessions[user_id] = []
+        for started, ended in sorted(streams):
+            if started >= start and ended <= end and \
+                    (not sessions[user_id] or started > sessions[user_id][-1][1] + 600):
+                sessions[user_id].append((started, ended))
+    return sessions
+
+
+def redis_sessions():
+    """
+    Streams recorded in redis, {user_id: [(started, ended), ...]}. The timestamps are when the bot noticed.
+    """
+    from TavernCrier.redis import rdb
+    from TavernCrier.util.state import stream_history_key
+
+    prefix = stream_history_key("")
+    sessions = {}
+    for key in rdb.scan_iter(match=prefix + "*", count=1000):
+        started = None
+        sessions[key[len(prefix):]] = streams = []
+        # History is newest first
+        for entry in reversed(rdb.lrange(key, 0, -1)):
+            event, _, timestamp = entry.partition(":")
+            if event == "online":
+                started = float(timestamp)
+            elif event == "offline" and started is not None:
+                streams.append((started, float(timestamp)))
+                started = None
+    return sessions
+
+
+def history(streams):
+    """
+    What `record_stream_history` would have left in redis for these streams, newest first.
+    """
+    entries = []
+    for started, ended in streams:
+        entries += [f"online:{started}", f"offline:{ended}"]
+    return entries[::-1][:100]
+
+
+def simulate(sessions, start, end, interval, select, polled=None, detected=None):
+    """
+    Steps through `start`..`end` one check at a time. Each tick `select(now, live_ids)` picks who's polled, anyone
+    polled is seen live or offline exactly as they are. Returns go live latencies, Helix requests made and streams
+    that were never noticed.
+    """
+    cursor = {user_id: 0 for user_id in sessions}
+    live = {}
+    latencies = []
+    requests = 0
+    ticks = 0
+    missed = 0
+
+    now = start
+    while now < end:
+        checked = select(now, set(live))
+        requests += -(-len(checked) // HELIX_MAX_IDS)
+        ticks += 1
+
+        for user_id in checked:
+            streams = sessions[user_id]
+            i = cursor[user_id]
+            while i < len(streams) and streams[i][1] <= now:
+                if live.get(user_id) != i:
+                    missed += 1
+                i += 1
+            cursor[user_id] = i
+            current = i if i < len(streams) and streams[i][0] <= now else None
+
+            if user_id in live and live[user_id] != current:
+                del live[user_id]
+                if detected:
+                    detected(user_id, "offline", now)
+            if current is not None and user_id not in live:
+                live[user_id] = current
+                latencies.append(now - streams[current][0])
+                if detected:
+                    detected(user_id, "online", now)
+
+        if polled:
+            polled(checked, now)
+        now += interval
+
+    # Streams that came and went without anyone looking
+    for user_id, streams in sessions.items():
+        for i in range(cursor[user_id], len(streams)):
+            if streams[i][1] <= end and live.get(user_id) != i:
+                missed += 1
+
+    return {'latencies': latencies, 'requests': requests, 'ticks': ticks, 'missed': missed}
+
+
+def fixed(sessions, start, end, args, every):
+    user_ids = set(sessions)
+    ticks = itertools.count()
+
+    def select(now, live_ids):
+        return user_ids if next(ticks) % every == 0 else live_ids
+    return simulate(sessions, start, end, args.check_interval, select)
+
+
+def adaptive(sessions, start, end, args, histories):
+    from TavernCrier.util.adaptive import AdaptivePollScheduler, StreamerProfile
+
+    class ReplayScheduler(AdaptivePollScheduler):
+        def _load_profiles(self, user_ids):
+            for user_id in user_ids:
+                if user_id not in self.profiles:
+                    self.profiles[user_id] = StreamerProfile(histories[user_id][:self.history_size])
+
+    scheduler = ReplayScheduler(args.check_interval, max_interval=args.max_interval, threshold=args.threshold,
+                                min_history=args.min_history, max_requests=args.max_requests)
+    user_ids = list(sessions)
+
+    def detected(user_id, event, now):
+        histories[user_id].insert(0, f"{event}:{now}")
+        scheduler.forget(user_id)
+
+    return simulate(sessions, start, end, args.check_interval, lambda now, live_ids: scheduler.select(
+        user_ids, live_ids, now), scheduler.polled, detected)
+
+
+def summarize(name, result, interval):
+    latencies = result['latencies']
+    minutes = result['ticks'] * interval / 60
+    return {'policy': name, 'requests_per_tick': result['requests'] / max(result['ticks'], 1),
+            'requests_per_minute': result['requests'] / max(minutes, 1), 'streams': len(latencies),
+            'missed': result['missed'], 'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+            'max': max(latencies, default=0)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streamers", type=int, default=1000, help="Synthetic streamers")
+    parser.add_argument("--weeks", type=int, default=8, help="Weeks of synthetic history before the replay")
+    parser.add_argument("--days", type=float, default=3, help="Days replayed")
+    parser.add_argument("--from-redis", action="store_true", help="Replay the stream_history recorded in redis")
+    parser.add_argument("--redis-host", default="127.0.0.1")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--redis-db", type=int, default=0, help="Only read from")
+    parser.add_argument("--check-interval", type=float, default=30, help="Seconds")
+    parser.add_argument("--max-interval", type=float, default=300, help="adaptive_polling.max_interval")
+    parser.add_argument("--threshold", type=float, default=0.25, help="adaptive_polling.likely_live_threshold")
+    parser.add_argument("--min-history", type=int, default=3, help="adaptive_polling.min_history")
+    parser.add_argument("--max-requests", type=int, default=10, help="adaptive_polling.max_requests_per_tick")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.set_defaults(fakeredis=False)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    harness.prepare_workdir(args)
+
+    if args.from_redis:
+        sessions = redis_sessions()
+        end = max((ended for streams in sessions.values() for _, ended in streams), default=0)
+        if not end:
+            print("No stream_history in redis", file=sys.stderr)
+            sys.exit(1)
+    else:
+        end = 1700000000 + random.uniform(0, WEEK)
+        sessions = synthetic_sessions(args.streamers, end - args.weeks * WEEK - args.days * DAY, end)
+    start = end - args.days * DAY
+
+    histories = {user_id: history([s for s in streams if s[1] <= start]) for user_id, streams in sessions.items()}
+    replayed = {user_id: [s for s in streams if s[0] >= start] for user_id, streams in sessions.items()}
+
+    results = [summarize("adaptive", adaptive(replayed, start, end, args, histories), args.check_interval),
+               summarize(f"fixed {args.check_interval:g}s", fixed(replayed, start, end, args, 1),
+                         args.check_interval)]
+    every = max(1, round(results[1]['requests_per_tick'] / max(results[0]['requests_per_tick'], 1e-9)))
+    if every > 1:
+        results.append(summarize(f"fixed {args.check_interval * every:g}s",
+                                 fixed(replayed, start, end, args, every), args.check_interval))
+
+    if args.json:
+        print(json.dumps({'streamers': len(sessions), 'days': args.days, 'results': results}, indent=2))
+        return
+
+    print(f"{len(sessions)} streamers, {sum(map(len, replayed.values()))} streams over {args.days:g} days, "
+          f"checked every {args.check_interval:g}s")
+    print(f"{'policy':>12} {'req/tick':>9} {'req/min':>8} {'streams':>8} {'missed':>7} {'p50':>8} {'p95':>8} "
+          f"{'max':>8}")
+    for r in results:
+        print(f"{r['policy']:>12} {r['requests_per_tick']:>9.2f} {r['requests_per_minute']:>8.1f} {r['streams']:>8} "
+              f"{r['missed']:>7} {r['p50']:>7.0f}s {r['p95']:>7.0f}s {r['max']:>7.0f}s")
+
+
+if __name__ == "__main__":
+    main()